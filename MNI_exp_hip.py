@@ -23,7 +23,10 @@ from sklearn.cross_decomposition import PLSRegression
 
 from utils.helpers import get_MNI_params, project_hemis_surf, project_hemis_chans
 from utils.plot_brain import plot_chans_on_surf
-from utils.R_convert import run_R_test_corr
+from utils.R_convert import run_R_test_corr_batch
+from utils.spin import run_spin_corr
+from utils.moran import run_moran
+from utils.pls import run_pls_cv
 from utils import plot_corr
 from utils.plot_helpers import fsize, save_fig, set_font_params, reset_default_rc
 
@@ -50,6 +53,18 @@ vmin = 1
 vmax = 3
 vspace = 1
 
+# If True, compute the spatial (spin) null of the correlations on n_null rotations
+spin_test = False
+n_null = 10000
+n_jobs = 1  # processes evaluating null maps and permutations
+
+# If True, compute global and local Moran's I of the parameter (n_perm permutations)
+moran_test = False
+n_perm = 9999
+
+# If True, choose and test the PLS axis out-of-sample (folds grouped by patient)
+pls_cv = False
+
 # Set font parameters for plots
 set_font_params()
 
@@ -129,47 +144,41 @@ df_data["pls_x"] = pls.x_scores_
 source_path = "./" + test_dir + "/" + test_name
 save_path = base_path + save_dir + "/"
 
-df_test_x = run_R_test_corr(
-    source_path,
-    df_data,
-    "mni_x",
-    param,
-    save_path,
-    save_name_add="HIP",
-    run_single=False,
-)
-df_test_y = run_R_test_corr(
-    source_path,
-    df_data,
-    "mni_y",
-    param,
-    save_path,
-    save_name_add="HIP",
-    run_single=False,
-)
-df_test_z = run_R_test_corr(
+df_tests = run_R_test_corr_batch(
     source_path,
     df_data,
-    "mni_z",
-    param,
+    [("mni_x", param), ("mni_y", param), ("mni_z", param), ("pls_x", param)],
     save_path,
     save_name_add="HIP",
     run_single=False,
+    families=["mni", "mni", "mni", "pls"],  # correct X, Y, Z tests together
 )
-df_test_pls = run_R_test_corr(
-    source_path,
-    df_data,
-    "pls_x",
-    param,
-    save_path,
-    save_name_add="HIP",
-    run_single=False,
-)
-
-# Correct X, Y, Z tests for multiple comparisons
-df_test_x.pval *= 3
-df_test_y.pval *= 3
-df_test_z.pval *= 3
+df_tests = df_tests.set_index("var_x")
+
+# Spatial (spin) null of the coordinate and PLS correlations
+if spin_test:
+    df_spin, _, _ = run_spin_corr(
+        df_data,
+        param,
+        save_path,
+        save_name_add="HIP",
+        surf=surf,
+        n_null=n_null,
+        n_jobs=n_jobs,
+    )
+    df_spin = df_spin.set_index("var_x")
+
+# Spatial autocorrelation (global and local Moran's I) of the parameter
+if moran_test:
+    df_moran, df_moran_local = run_moran(
+        df_data, param, save_path, save_name_add="HIP", n_perm=n_perm, n_jobs=n_jobs
+    )
+
+# PLS axis chosen and tested out-of-sample (folds grouped by patient)
+if pls_cv:
+    df_pls_cv, df_pls_axis, _ = run_pls_cv(
+        df_data, param, save_path, save_name_add="HIP", n_jobs=n_jobs
+    )
 
 ###
 # Plots
@@ -181,7 +190,7 @@ ax = plot_corr.plot(
     ax,
     df_data.mni_x,
     df_data[param],
-    df_fit=df_test_x.iloc[0],
+    df_fit=df_tests.loc["mni_x"],
     xy_annot=(0.7, 0.8),
     ylabel="Baseline exponent [a.u.]",
     xlabel="MNI X coordinate [mm]",
@@ -207,7 +216,7 @@ ax = plot_corr.plot(
     ax,
     df_data.mni_y,
     df_data[param],
-    df_fit=df_test_y.iloc[0],
+    df_fit=df_tests.loc["mni_y"],
     xy_annot=(0.8, 0.05),
     ylabel="Baseline exponent [a.u.]",
     xlabel="MNI Y coordinate [mm]",
@@ -233,7 +242,7 @@ ax = plot_corr.plot(
     ax,
     df_data.mni_z,
     df_data[param],
-    df_fit=df_test_z.iloc[0],
+    df_fit=df_tests.loc["mni_z"],
     xy_annot=(0.8, 0.8),
     ylabel="Baseline exponent [a.u.]",
     xlabel="MNI Z coordinate [mm]",
@@ -259,7 +268,7 @@ ax = plot_corr.plot(
     ax,
     df_data.pls_x,
     df_data[param],
-    df_fit=df_test_pls.iloc[0],
+    df_fit=df_tests.loc["pls_x"],
     xy_annot=(0.05, 0.8),
     ylabel="Baseline exponent [a.u.]",
     xlabel="PLS scores",
@@ -14,6 +14,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from utils.R_convert import run_R_test_regs_multiple
+from utils.functional import run_test_functional
 from utils import plot_seq_regs
 from utils.helpers import compute_sig_blocks
 from utils.plot_helpers import save_fig, fsize, set_font_params, reset_default_rc
@@ -31,6 +32,9 @@ save_dir = "Autocorrelation"
 save_name = "ACF_regs"
 save_format = "svg"
 
+# If True, fit a single functional LME over all lags instead of one LME per lag
+functional_test = False
+
 # Set font parameters for plots
 set_font_params()
 
@@ -47,9 +51,12 @@ df_acf = pd.read_csv(path.join(base_path, data_dir, data_name), index_col=0)
 # Run LME test
 source_path = "./" + test_dir + "/" + test_name
 save_path = base_path + save_dir + "/"
-df_coef, df_stats = run_R_test_regs_multiple(
-    source_path, df_acf, save_path, save_name_add="ACF"
-)
+if functional_test:
+    df_coef, df_stats, _ = run_test_functional(df_acf, save_path, save_name_add="ACF")
+else:
+    df_coef, df_stats = run_R_test_regs_multiple(
+        source_path, df_acf, save_path, save_name_add="ACF"
+    )
 
 # Format dataframes
 cols_mean = [c for c in df_coef.columns if "mean" in c]
@@ -86,9 +93,14 @@ save_fig(fig, path.join(base_path, save_dir), save_name, save_format)
 
 # Run LME test
 df_acf_resp = df_acf[df_acf.resp == 1]
-df_coef, df_stats = run_R_test_regs_multiple(
-    source_path, df_acf_resp, save_path, save_name_add="ACF_resp"
-)
+if functional_test:
+    df_coef, df_stats, _ = run_test_functional(
+        df_acf_resp, save_path, save_name_add="ACF_resp"
+    )
+else:
+    df_coef, df_stats = run_R_test_regs_multiple(
+        source_path, df_acf_resp, save_path, save_name_add="ACF_resp"
+    )
 
 # Format dataframes
 cols_mean = [c for c in df_coef.columns if "mean" in c]
@@ -14,6 +14,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 
 from utils.R_convert import run_R_test_regs
+from utils.sensitivity import run_lopo_regs
 from utils import plot_cat_regs
 from utils.plot_significance import catplot_annot_sign
 from utils.plot_helpers import save_fig, set_font_params, reset_default_rc
@@ -50,6 +51,9 @@ source_path = "./" + test_dir + "/" + test_name
 save_path = base_path + save_dir + "/"
 df_coef, df_stats = run_R_test_regs(source_path, df_tau, "tau", save_path)
 
+# Leave-one-patient-out sensitivity of the test
+df_lopo, df_infl = run_lopo_regs(df_tau, "tau", save_path)
+
 # Plot: distribution of characteristic timescales per region
 df_plot = df_tau.copy()
 fig, ax = plt.subplots(1, 1, figsize=(5, 5))
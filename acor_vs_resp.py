@@ -15,8 +15,10 @@ import pandas as pd
 import matplotlib.pyplot as plt
 
 from utils.helpers import get_resp_params
-from utils.R_convert import run_R_test_corr
-from utils import plot_corr
+from utils.R_convert import run_R_test_corr_batch
+from utils.sensitivity import run_lopo_corr
+from utils.lme import run_test_corr_multiple, corr_multiple_tables
+from utils import plot_corr, plot_seq_regs
 from utils.plot_helpers import save_fig, color, set_font_params, reset_default_rc
 
 
@@ -28,12 +30,18 @@ base_path = ""
 data_dir = ""
 data_name = ""
 resp_name = ""
+acf_name = ""
 test_dir = "LMEs"
 test_name = "LME_corr.R"
 save_dir = "Responses"
 save_name = "Corr_tau"
 save_format = "svg"
 
+# y-axis of the lag-resolved slopes
+vmin = -300
+vmax = 300
+vspace = 150
+
 # Set font parameters for plots
 set_font_params()
 
@@ -56,12 +64,26 @@ df_data = get_resp_params(df_resp, df_tau, ["tau"])
 
 source_path = "./" + test_dir + "/" + test_name
 save_path = base_path + save_dir + "/"
-df_test_onset = run_R_test_corr(source_path, df_data, "tau", "onset", save_path)
-df_test_peak = run_R_test_corr(source_path, df_data, "tau", "peak", save_path)
+df_tests = run_R_test_corr_batch(
+    source_path,
+    df_data,
+    [("tau", "onset"), ("tau", "peak")],
+    save_path,
+    correction=None,
+)
+
+# Split by latency and re-index with 'Group' column
+df_test_onset = df_tests[df_tests.var_y == "onset"].set_index("Group")
+df_test_peak = df_tests[df_tests.var_y == "peak"].set_index("Group")
+
+# Leave-one-patient-out sensitivity of the correlations with all regions
+df_lopo_onset, df_infl_onset = run_lopo_corr(df_data, "tau", "onset", save_path)
+df_lopo_peak, df_infl_peak = run_lopo_corr(df_data, "tau", "peak", save_path)
 
-# Re-index with 'Group' column
-df_test_onset = df_test_onset.set_index("Group")
-df_test_peak = df_test_peak.set_index("Group")
+# Lag-resolved correlations of ACF values with latencies, fitted over all lags at once
+if acf_name:
+    df_acf = pd.read_csv(path.join(base_path, data_dir, acf_name), index_col=0)
+    res_lags = run_test_corr_multiple(df_acf, df_resp, save_path, save_name_add="ACF")
 
 ###
 # 1) Correlation with all regions together
@@ -155,5 +177,42 @@ for i, reg in enumerate(df_tau.region.unique()):
         fig, path.join(base_path, save_dir), "Corr_peak_tau_" + reg, format=save_format,
     )
 
+###
+# 3) Lag-resolved correlations of ACF values with latencies
+###
+
+if acf_name:
+    lags = df_acf.columns[3:].astype(np.float64)
+    for lat, (df_test_lags, sign_blocks) in res_lags.items():
+
+        # Keep fitted lags only (the ACF is constant at lag 0)
+        df_mean, df_sem = corr_multiple_tables(df_test_lags, "m")
+        fitted = df_mean.notna().all(axis=1).to_numpy()
+        new_idx = np.cumsum(fitted) - 1
+        df_mean = df_mean[fitted].reset_index(drop=True)
+        df_sem = df_sem[fitted].reset_index(drop=True)
+
+        # Significant lags of the regression with all regions together
+        fig, ax = plt.subplots(1, 1, figsize=(5, 5))
+        ax = plot_seq_regs.plot(
+            ax,
+            lags[fitted],
+            df_mean,
+            df_sem,
+            sign_blocks=[new_idx[block] for block in sign_blocks["Overall"]],
+            xticks=np.arange(0, 260, 50),
+            yticks=np.arange(vmin, vmax + vspace, vspace),
+            xlabel="Time-lag [ms]",
+            ylabel="Slope [ms / ACF]",
+            linewidth=2,
+        )
+        ax.axhline(0, lw=0.5, ls="--", c="k")
+        save_fig(
+            fig,
+            path.join(base_path, save_dir),
+            "Corr_" + lat + "_ACF",
+            format=save_format,
+        )
+
 # Restore params
 reset_default_rc()
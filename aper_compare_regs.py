@@ -13,7 +13,7 @@ from os import path
 import pandas as pd
 import matplotlib.pyplot as plt
 
-from utils.R_convert import run_R_test_regs
+from utils.R_convert import run_R_test_regs_batch
 from utils import plot_cat_regs
 from utils.plot_significance import catplot_annot_sign
 from utils.plot_helpers import save_fig, set_font_params, reset_default_rc
@@ -43,18 +43,29 @@ df_aper = pd.read_csv(path.join(base_path, data_dir, data_name), index_col=0)
 df_aper.drop(columns=["subreg"], inplace=True)
 
 ###
-# Complete dataset
+# Run LME tests (all channels and responsive ones)
 ###
 
-# EXPONENT
-
-# Run LME test
 source_path = "./" + test_dir + "/" + test_name
 save_path = base_path + save_dir + "/"
-df_coef, df_stats = run_R_test_regs(
-    source_path, df_aper, "exp", save_path, save_name_add=save_test_name
+df_coef_all, df_stats_all = run_R_test_regs_batch(
+    source_path,
+    df_aper,
+    ["exp", "off"],
+    save_path,
+    save_name_add=save_test_name,
+    subsets={"all": None, "resp": "resp == 1"},
 )
 
+###
+# Complete dataset
+###
+
+# EXPONENT
+
+df_coef = df_coef_all.loc[("exp", "all")]
+df_stats = df_stats_all.loc[("exp", "all")]
+
 # Plot: distribution of characteristic timescales per region
 df_plot = df_aper.copy()
 fig, ax = plt.subplots(1, 1, figsize=(5, 5))
@@ -75,12 +86,8 @@ save_fig(fig, path.join(base_path, save_dir), save_name + "_exp", save_format)
 
 # OFFSET
 
-# Run LME test
-source_path = "./" + test_dir + "/" + test_name
-save_path = base_path + save_dir + "/"
-df_coef, df_stats = run_R_test_regs(
-    source_path, df_aper, "off", save_path, save_name_add=save_test_name
-)
+df_coef = df_coef_all.loc[("off", "all")]
+df_stats = df_stats_all.loc[("off", "all")]
 
 # Plot: distribution of characteristic timescales per region
 df_plot = df_aper.copy()
@@ -107,11 +114,9 @@ save_fig(fig, path.join(base_path, save_dir), save_name + "_off", save_format)
 
 # EXPONENT
 
-# Run LME test
 df_aper_resp = df_aper[df_aper.resp == 1]
-df_coef_resp, df_stats_resp = run_R_test_regs(
-    source_path, df_aper_resp, "exp", save_path, save_name_add="resp_" + save_test_name
-)
+df_coef_resp = df_coef_all.loc[("exp", "resp")]
+df_stats_resp = df_stats_all.loc[("exp", "resp")]
 
 # Plot: distribution of characteristic timescales per region
 df_plot = df_aper_resp.copy()
@@ -132,10 +137,8 @@ save_fig(fig, path.join(base_path, save_dir), save_name + "_exp_resp", save_form
 
 # OFFSET
 
-# Run LME test
-df_coef_resp, df_stats_resp = run_R_test_regs(
-    source_path, df_aper_resp, "off", save_path, save_name_add="resp_" + save_test_name
-)
+df_coef_resp = df_coef_all.loc[("off", "resp")]
+df_stats_resp = df_stats_all.loc[("off", "resp")]
 
 # Plot: distribution of characteristic timescales per region
 df_plot = df_aper_resp.copy()
@@ -15,7 +15,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 
 from utils.helpers import get_resp_params
-from utils.R_convert import run_R_test_corr
+from utils.R_convert import run_R_test_corr_batch
 from utils import plot_corr
 from utils.plot_helpers import save_fig, color, set_font_params, reset_default_rc
 
@@ -56,12 +56,17 @@ df_data = get_resp_params(df_resp, df_aper, ["exp"])
 
 source_path = "./" + test_dir + "/" + test_name
 save_path = base_path + save_dir + "/"
-df_test_onset = run_R_test_corr(source_path, df_data, "exp", "onset", save_path)
-df_test_peak = run_R_test_corr(source_path, df_data, "exp", "peak", save_path)
+df_tests = run_R_test_corr_batch(
+    source_path,
+    df_data,
+    [("exp", "onset"), ("exp", "peak")],
+    save_path,
+    correction=None,
+)
 
-# Re-index with 'Group' column
-df_test_onset = df_test_onset.set_index("Group")
-df_test_peak = df_test_peak.set_index("Group")
+# Split by latency and re-index with 'Group' column
+df_test_onset = df_tests[df_tests.var_y == "onset"].set_index("Group")
+df_test_peak = df_tests[df_tests.var_y == "peak"].set_index("Group")
 
 ###
 # 1) Correlation with all regions together
@@ -3,7 +3,9 @@ Compare Power Spectral Density (PSD) profiles across brain regions.
 
 The script reads data contained in the csv file specified by data_name,
 where the PSD values for each channel are already stored.
-The test_name file allows to run Linear Mixed models tests of significance.
+The test_name file allows to run Linear Mixed models tests of significance
+(engine = "R"), or the same tests are run at all frequencies at once in Python
+(engine = "python", see utils/lme.py).
 
 The data is then plotted in as the mean for each region at every frequency.
 """
@@ -14,6 +16,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from utils.R_convert import run_R_test_regs_multiple
+from utils.lme import run_test_regs_multiple
+from utils.functional import run_test_functional
 from utils import plot_seq_regs
 from utils.plot_helpers import save_fig, color, fsize, set_font_params, reset_default_rc
 
@@ -32,6 +36,12 @@ save_format = "svg"
 
 freqs_plot = [1, 150]
 
+# LME engine: "R" (test_name file) or "python" (utils/lme.py, all steps at once)
+engine = "R"
+
+# If True, fit a single functional LME over all (log-)frequencies
+functional_test = False
+
 # Set font parameters for plots
 set_font_params()
 
@@ -54,9 +64,16 @@ df_psd.iloc[:, 3:] = np.log10(df_psd.iloc[:, 3:])
 # Run LME test
 source_path = "./" + test_dir + "/" + test_name
 save_path = base_path + save_dir + "/"
-df_coef, _ = run_R_test_regs_multiple(
-    source_path, df_psd, save_path, save_name_add="PSD"
-)
+if functional_test:
+    df_coef, _, _ = run_test_functional(
+        df_psd, save_path, save_name_add="PSD", log_steps=True
+    )
+elif engine == "R":
+    df_coef, _ = run_R_test_regs_multiple(
+        source_path, df_psd, save_path, save_name_add="PSD"
+    )
+else:
+    df_coef, _ = run_test_regs_multiple(df_psd, save_path, save_name_add="PSD")
 
 # Format dataframes
 cols_mean = [c for c in df_coef.columns if "mean" in c]
@@ -99,9 +116,18 @@ save_fig(fig, path.join(base_path, save_dir), save_name, save_format)
 
 # Run LME test
 df_psd_resp = df_psd[df_psd.resp == 1]
-df_coef, _ = run_R_test_regs_multiple(
-    source_path, df_psd_resp, save_path, save_name_add="PSD_resp"
-)
+if functional_test:
+    df_coef, _, _ = run_test_functional(
+        df_psd_resp, save_path, save_name_add="PSD_resp", log_steps=True
+    )
+elif engine == "R":
+    df_coef, _ = run_R_test_regs_multiple(
+        source_path, df_psd_resp, save_path, save_name_add="PSD_resp"
+    )
+else:
+    df_coef, _ = run_test_regs_multiple(
+        df_psd_resp, save_path, save_name_add="PSD_resp"
+    )
 
 # Format dataframes
 cols_mean = [c for c in df_coef.columns if "mean" in c]
@@ -0,0 +1,98 @@
+"""
+Plot frequency-resolved correlation of Power Spectral Density (PSD) with auditory
+evoked responses latencies.
+
+The script reads data contained in the csv files specified by data_name and
+resp_name, where the PSD values and latencies for each channel are already stored.
+Linear Mixed models regressions of the latencies on the log-PSD are run at all
+frequencies at once (see utils/lme.py).
+
+The data is then plotted as the slope of the regression in each region at every
+frequency.
+"""
+
+from os import path
+import pandas as pd
+import numpy as np
+import matplotlib.pyplot as plt
+
+from utils.lme import run_test_corr_multiple, corr_multiple_tables
+from utils import plot_seq_regs
+from utils.plot_helpers import save_fig, color, set_font_params, reset_default_rc
+
+###
+# Paths and parameters
+###
+
+base_path = ""
+data_dir = ""
+data_name = ""
+resp_name = ""
+save_dir = "Responses"
+save_name = "Corr_PSD"
+save_format = "svg"
+
+freqs_plot = [1, 150]
+
+# y-axis of the slopes
+vmin = -60
+vmax = 60
+vspace = 30
+
+# Set font parameters for plots
+set_font_params()
+
+###
+# Load data
+###
+
+df_psd = pd.read_csv(path.join(base_path, data_dir, data_name), index_col=0)
+df_resp = pd.read_csv(path.join(base_path, data_dir, resp_name), index_col=0)
+freqs = df_psd.columns[3:].astype(np.float64)
+freqs = freqs[np.logical_and(freqs >= freqs_plot[0], freqs <= freqs_plot[1])]
+df_psd = df_psd.loc[:, ["chan", "resp", "region"] + [str(f) for f in freqs]]
+
+# Transform in log
+df_psd.iloc[:, 3:] = np.log10(df_psd.iloc[:, 3:])
+
+###
+# Run LME regressions at all frequencies
+###
+
+save_path = base_path + save_dir + "/"
+res = run_test_corr_multiple(df_psd, df_resp, save_path, save_name_add="PSD")
+
+###
+# Plot: slopes per region at every frequency
+###
+
+for lat, (df_test, sign_blocks) in res.items():
+
+    df_mean, df_sem = corr_multiple_tables(df_test, "m")
+
+    # Significant frequencies of the regression with all regions together
+    fig, ax = plt.subplots(1, 1, figsize=(3.5, 7))
+    ax = plot_seq_regs.plot(
+        ax,
+        freqs,
+        df_mean,
+        df_sem,
+        sign_blocks=sign_blocks["Overall"],
+        logx=True,
+        logy=False,
+        xticks=[1, 10, 100, 150],
+        yticks=np.arange(vmin, vmax + vspace, vspace),
+        xlabel="Frequency [Hz]",
+        ylabel=r"Slope [ms / log$_{10}$($\mu V^2$/Hz)]",
+        linewidth=2,
+    )
+    ax.axhline(0, lw=0.5, ls="--", c="k")
+    # Aperiodic fit limits
+    ax.axvspan(20, 35, color=color.brown, alpha=0.2)
+    ax.axvspan(80, 150, color=color.brown, alpha=0.2)
+    ax.set_xlim(freqs_plot)
+
+    save_fig(fig, path.join(base_path, save_dir), save_name + "_" + lat, save_format)
+
+# Restore params
+reset_default_rc()
@@ -13,7 +13,7 @@ from os import path
 import pandas as pd
 import matplotlib.pyplot as plt
 
-from utils.R_convert import run_R_test_regs
+from utils.R_convert import run_R_test_regs_batch
 from utils import plot_cat_regs
 from utils.plot_significance import catplot_annot_sign
 from utils.plot_helpers import save_fig, set_font_params, reset_default_rc
@@ -46,10 +46,13 @@ df_resp.drop(columns=["subreg"], inplace=True)
 
 source_path = "./" + test_dir + "/" + test_name
 save_path = base_path + save_dir + "/"
-df_coef_onset, df_stats_onset = run_R_test_regs(
-    source_path, df_resp, "onset", save_path
+df_coef_all, df_stats_all = run_R_test_regs_batch(
+    source_path, df_resp, ["onset", "peak"], save_path
 )
-df_coef_peak, df_stats_peak = run_R_test_regs(source_path, df_resp, "peak", save_path)
+df_coef_onset = df_coef_all.loc[("onset", "all")]
+df_stats_onset = df_stats_all.loc[("onset", "all")]
+df_coef_peak = df_coef_all.loc[("peak", "all")]
+df_stats_peak = df_stats_all.loc[("peak", "all")]
 
 ###
 # Plot distributions per region
@@ -1,8 +1,15 @@
 """
 Colection of functions to convert between Python objects and R objects.
+
+If pyarrow, rpy2-arrow and the R 'arrow' package are installed, dataframes are
+transferred as Arrow tables (whole columns shared between Python and R)
+instead of being converted column by column with pandas2ri.
 """
 
 import os
+import warnings
+import numpy as np
+import pandas as pd
 
 # Set correctly R home path
 os.environ["R_HOME"] = r"C:/Program Files/R/R-4.2.0"
@@ -10,10 +17,56 @@ os.environ["R_HOME"] = r"C:/Program Files/R/R-4.2.0"
 import rpy2.robjects as ro
 from rpy2.robjects.conversion import localconverter
 from rpy2.robjects import pandas2ri
+from rpy2.rinterface_lib.embedded import RRuntimeError
+
+from utils import checkpoint
+from utils.helpers import stack_corr_tests, stack_regs_tests
+from utils.R_pool import RWorkerPool
+from utils.cache import cached, cache_key
+
+# Optional Arrow transfer
+try:
+    import pyarrow as pa
+    import rpy2_arrow.arrow as pyra
+
+    # Plain R data.frame (not tibble) from an R arrow Table, with given row names
+    _r_arrow_to_df = ro.r(
+        "function(tbl, rn) { df <- as.data.frame(as.data.frame(tbl)); rownames(df) <- rn; df }"
+    )
+    use_arrow = True
+except (ImportError, RuntimeError, ValueError):
+    use_arrow = False
+
+# R files already sourced in this session: path -> (modification time, compute_test)
+_r_sourced = {}
+
+
+def _source_R(source_path):
+    """Source R file (once per session) and return its compute_test function"""
+
+    key = os.path.abspath(source_path)
+    mtime = os.path.getmtime(source_path)
 
+    # Source again only if the file changed, each file in its own environment
+    if key not in _r_sourced or _r_sourced[key][0] != mtime:
+        env = ro.r["new.env"]()
+        ro.r["source"](source_path, local=env)
+        _r_sourced[key] = (mtime, env["compute_test"])
 
-def _convert_pydf(pydf):
-    """Convert pandas df to R dataframe"""
+    return _r_sourced[key][1]
+
+
+def _convert_pydf(pydf, columns=None):
+    """Convert pandas df to R dataframe, keeping only columns (if given)"""
+
+    # Project columns before transfer
+    if columns is not None:
+        pydf = pydf.loc[:, columns]
+
+    if use_arrow:
+        tbl = pa.Table.from_pandas(pydf, preserve_index=False)
+        row_names = ro.StrVector([str(i) for i in pydf.index])
+        return _r_arrow_to_df(pyra.pyarrow_table_to_r_table(tbl), row_names)
 
     with localconverter(ro.default_converter + pandas2ri.converter):
         data = ro.conversion.py2rpy(pydf)
@@ -21,22 +74,99 @@ def _convert_pydf(pydf):
     return data
 
 
+def _rdf_to_pandas(r_df):
+    """Convert a single R dataframe to pandas"""
+
+    if use_arrow:
+        tbl = pyra.rarrow_to_py_table(ro.r("arrow::arrow_table")(r_df))
+        df = tbl.to_pandas()
+        df.index = list(ro.r["rownames"](r_df))
+        return df
+
+    with localconverter(ro.default_converter + pandas2ri.converter):
+        df = ro.conversion.rpy2py(r_df)
+
+    return df
+
+
 def _convert_rdf(rdf):
     """Convert (a list of) R dataframes to pandas ones"""
 
     if isinstance(rdf, ro.vectors.DataFrame):
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            df = ro.conversion.rpy2py(rdf)
-        return df
+        return _rdf_to_pandas(rdf)
     else:
-        df_list = []
-        for r_df in rdf:
-            with localconverter(ro.default_converter + pandas2ri.converter):
-                df = ro.conversion.rpy2py(r_df)
-                df_list.append(df)
-        return df_list
+        return [_rdf_to_pandas(r_df) for r_df in rdf]
+
+
+def _save_name(save_name_add):
+    """Additional string of saved file names, as formatted by the R files"""
+
+    return "_" + save_name_add if save_name_add != "" else ""
+
+
+def _subset_save_name(subset, query, save_name_add):
+    """save_name_add of the tests on a subset of rows (None query for all rows)"""
+
+    return "_".join(s for s in [None if query is None else subset, save_name_add] if s)
+
+
+def _files_regs(args):
+    """Files written by run_R_test_regs"""
 
+    # Names of both LME_regs_single.R and LME_subregs_single.R
+    save_name = args["var"] + _save_name(args["save_name_add"]) + ".csv"
+    return [
+        args["save_path"] + "Test_" + test + sub + save_name
+        for test in ["coef_", "pval_"]
+        for sub in ["", "subreg_"]
+    ]
 
+
+def _files_regs_batch(args):
+    """Files written by run_R_test_regs_batch"""
+
+    subsets = args["subsets"] if args["subsets"] is not None else {"all": None}
+    return [
+        f
+        for subset, query in subsets.items()
+        for var in args["variables"]
+        for f in _files_regs(
+            dict(
+                args,
+                var=var,
+                save_name_add=_subset_save_name(subset, query, args["save_name_add"]),
+            )
+        )
+    ]
+
+
+def _files_regs_multiple(args):
+    """Files written by run_R_test_regs_multiple"""
+
+    save_name = _save_name(args["save_name_add"]) + ".csv"
+    return [
+        args["save_path"] + test + save_name
+        for test in ["Test_coef", "Test_pval", "Test_pairs"]
+    ]
+
+
+def _files_corr(args):
+    """Files written by run_R_test_corr"""
+
+    return _files_corr_batch(dict(args, pairs=[(args["var_x"], args["var_y"])]))[:-1]
+
+
+def _files_corr_batch(args):
+    """Files written by run_R_test_corr_batch"""
+
+    save_name = _save_name(args["save_name_add"]) + ".csv"
+    return [
+        args["save_path"] + "Test_corr_" + var_x + "_" + var_y + save_name
+        for var_x, var_y in args["pairs"]
+    ] + [args["save_path"] + "Test_corr_batch" + save_name]
+
+
+@cached(_files_regs)
 def run_R_test_regs(
     source_path, df_data, var, save_path, save_name_add="", convert=True
 ):
@@ -45,13 +175,144 @@ def run_R_test_regs(
     # First, make the index a column
     df_data_r = df_data.reset_index()
 
+    # Convert df_data to R object (only needed columns)
+    data = _convert_pydf(df_data_r, columns=["pat", "region", var])
+
+    # Run test in R file
+    compute_test = _source_R(source_path)
+    r_df_list = compute_test(data, var, save_path, save_name_add)
+
+    # Convert a list of R dataframes to pandas ones
+    if convert:
+        df_list = _convert_rdf(r_df_list)
+        return df_list
+
+    return r_df_list
+
+
+# Rows of an R dataframe, given their (1-based) indexes
+_r_select_rows = ro.r("function(data, idx) data[idx, , drop = FALSE]")
+
+
+def _run_R_regs_combs(
+    source_path, df_data_r, combs, subsets, save_path, save_name_add="", convert=True
+):
+    """Run region tests of several (variable, subset) combinations on the same data,
+    converted to R only once. Always returns a list of lists of pandas dataframes."""
+
+    # Convert needed columns of df_data to R object
+    var_names = list(dict.fromkeys([var for var, _ in combs]))
+    data = _convert_pydf(df_data_r, ["pat", "region"] + var_names)
+
+    # Run tests in R file, on subsets of rows selected in R
+    compute_test = _source_R(source_path)
+    data_subsets = {}
+    results = []
+    for var, subset in combs:
+        query = subsets[subset]
+        if subset not in data_subsets:
+            if query is None:
+                data_subsets[subset] = data
+            else:
+                idx = np.where(df_data_r.eval(query))[0] + 1
+                data_subsets[subset] = _r_select_rows(data, ro.IntVector(idx))
+        save_name = _subset_save_name(subset, query, save_name_add)
+        r_df_list = compute_test(data_subsets[subset], var, save_path, save_name)
+        results.append(_convert_rdf(r_df_list))
+
+    return results
+
+
+@cached(_files_regs_batch)
+def run_R_test_regs_batch(
+    source_path,
+    df_data,
+    variables,
+    save_path,
+    save_name_add="",
+    subsets=None,
+    n_jobs=1,
+    pool=None,
+):
+    """Run tests over categories (regions) for several variables and subsets
+    of rows in R file and return pandas objects.
+
+    subsets is a dict of subset names and pandas queries selecting their rows
+    (e.g. {"all": None, "resp": "resp == 1"}, None for all rows), default to all rows.
+    Data are converted to R once (once per worker if n_jobs > 1 or a RWorkerPool
+    is given, in which case combinations are split among the workers). Each test is
+    saved as in run_R_test_regs, with the subset name prepended to save_name_add
+    (joined by '_' if save_name_add is not empty) for subsets other than all rows.
+
+    Returns coefficients and test dataframes of all tests in long format,
+    indexed by (variable, subset, row): df_coef.loc[("exp", "resp")] gives
+    the coefficients of 'exp' on the 'resp' subset, as from run_R_test_regs.
+    """
+
+    # First, make the index a column
+    df_data_r = df_data.reset_index()
+    if subsets is None:
+        subsets = {"all": None}
+    combs = [(var, subset) for subset in subsets for var in variables]
+
+    if n_jobs > 1 or pool is not None:
+        own_pool = pool is None
+        if own_pool:
+            pool = RWorkerPool(source_path, n_workers=min(n_jobs, len(combs)))
+        try:
+            blocks = [
+                b for b in np.array_split(np.arange(len(combs)), pool.n_workers)
+                if len(b) > 0
+            ]
+            futures = [
+                pool.submit(
+                    "_run_R_regs_combs",
+                    source_path,
+                    df_data_r,
+                    [combs[i] for i in b],
+                    subsets,
+                    save_path,
+                    save_name_add,
+                )
+                for b in blocks
+            ]
+            results = [res for f in futures for res in f.result()]
+        finally:
+            if own_pool:
+                pool.close()
+    else:
+        results = _run_R_regs_combs(
+            source_path, df_data_r, combs, subsets, save_path, save_name_add
+        )
+
+    return stack_regs_tests(results, combs)
+
+
+def _write_csv_R(df, save_file):
+    """Save pandas df to csv file with R"""
+
+    ro.r["write.csv"](_convert_pydf(df), save_file)
+
+
+def _run_R_steps(
+    source_path, df_data_r, n_tests, warm_start=False, pairwise=False, convert=True
+):
+    """Run test for multiple 'steps' on a block of the steps, without saving."""
+
     # Convert df_data to R object
     data = _convert_pydf(df_data_r)
 
-    # Run test in R file
-    r = ro.r
-    r.source(source_path)
-    r_df_list = r.compute_test(data, var, save_path, save_name_add)
+    # Run test in R file, correcting for the total number of steps
+    compute_test = _source_R(source_path)
+    r_df_list = compute_test(
+        data,
+        "",
+        "",
+        n_tests=n_tests,
+        save=False,
+        warm_start=warm_start,
+        pairwise=pairwise,
+    )
 
     # Convert a list of R dataframes to pandas ones
     if convert:
@@ -61,22 +322,261 @@ def run_R_test_regs(
     return r_df_list
 
 
+def _fit_R_steps(
+    source_path, df_data_r, steps_idx, pool=None, warm_start=False, pairwise=False
+):
+    """Fit a subset of the steps (indexes among steps), in blocks run by the
+    pool workers if a pool is given, and return the results in step order."""
+
+    # Steps are all columns after pat, chan, resp and region
+    n_steps = df_data_r.shape[1] - 4
+    n_blocks = 1 if pool is None else pool.n_workers
+    blocks = [b for b in np.array_split(np.asarray(steps_idx), n_blocks) if len(b) > 0]
+    df_blocks = [df_data_r.iloc[:, list(range(4)) + list(b + 4)] for b in blocks]
+
+    if pool is None:
+        results = [
+            _run_R_steps(source_path, df, n_steps, warm_start, pairwise)
+            for df in df_blocks
+        ]
+    else:
+        futures = [
+            pool.submit("_run_R_steps", source_path, df, n_steps, warm_start, pairwise)
+            for df in df_blocks
+        ]
+        results = [f.result() for f in futures]
+
+    # Merge back in step order
+    df_list = [pd.concat([res[i] for res in results]) for i in range(len(results[0]))]
+
+    return df_list
+
+
+def _fit_R_steps_adaptive(
+    source_path, df_data_r, coarse_step, alpha, alpha_margin=10, pool=None
+):
+    """Fit a coarse grid of steps, then refine (by bisection) every interval between
+    fitted steps with different significance, or with a p-value within a factor
+    alpha_margin of alpha at either end. Other steps are interpolated, so blocks
+    inside intervals far from alpha at both ends are not found."""
+
+    n_steps = df_data_r.shape[1] - 4
+    fitted = np.zeros(n_steps, dtype=bool)
+    pval = np.full(n_steps, np.nan)
+    coef = None
+
+    to_fit = np.unique(np.r_[np.arange(0, n_steps, coarse_step), n_steps - 1])
+    while len(to_fit) > 0:
+        df_coef, df_test = _fit_R_steps(source_path, df_data_r, to_fit, pool)
+        if coef is None:
+            coef = np.full((n_steps, df_coef.shape[1]), np.nan)
+        coef[to_fit] = df_coef.to_numpy()
+        pval[to_fit] = df_test.pval.to_numpy()
+        fitted[to_fit] = True
+
+        # Bisect gaps where significance switches, or close to alpha at either end
+        # (a narrow block may lie between two steps with the same significance)
+        idx = np.where(fitted)[0]
+        sig = pval[idx] < alpha
+        with np.errstate(divide="ignore", invalid="ignore"):
+            near = np.abs(np.log10(pval[idx] / alpha)) < np.log10(alpha_margin)
+        refine = (sig[1:] != sig[:-1]) | near[1:] | near[:-1]
+        change = np.where(refine & (np.diff(idx) > 1))[0]
+        to_fit = (idx[change] + idx[change + 1]) // 2
+
+    # Fill not fitted steps (always between two fitted steps with the same significance)
+    idx = np.where(fitted)[0]
+    steps_all = np.arange(n_steps)
+    coef = np.stack(
+        [np.interp(steps_all, idx, coef[idx, j]) for j in range(coef.shape[1])], axis=1
+    )
+    log_pval = np.log10(np.maximum(pval[idx], np.finfo(float).tiny))
+    pval = 10 ** np.interp(steps_all, idx, log_pval)
+
+    # Narrow blocks were found, others may lie between coarse steps far from alpha
+    sig = np.r_[False, pval < alpha, False]
+    widths = np.diff(np.where(np.diff(sig))[0])
+    if (widths < coarse_step).any():
+        warnings.warn(
+            "Blocks narrower than coarse_step found: significance blocks may differ "
+            "from the full run, use a smaller coarse_step (or adaptive=False)."
+        )
+
+    df_coef = pd.DataFrame(coef, columns=df_coef.columns)
+    df_test = pd.DataFrame(
+        {
+            "steps": df_data_r.columns[4:].astype(np.float64),
+            "pval": pval,
+            "fitted": fitted,
+        }
+    )
+
+    return [df_coef, df_test]
+
+
+def _fit_R_steps_checkpoint(
+    source_path,
+    df_data_r,
+    checkpoint_file,
+    checkpoint_every=50,
+    pool=None,
+    warm_start=False,
+    retry_failed=False,
+):
+    """Fit all steps in blocks of checkpoint_every steps, saving results to
+    checkpoint_file after each block and skipping steps already done.
+    If a block fails, its steps are fitted one by one and failures are recorded."""
+
+    n_steps = df_data_r.shape[1] - 4
+    key = cache_key(_run_R_steps, source_path, df_data_r, n_steps, warm_start)
+    state = checkpoint.load(checkpoint_file, key)
+    if state is None:
+        state = checkpoint.new(key, n_steps)
+
+    todo = ~state["done"]
+    if retry_failed:
+        todo |= state["failed"]
+    todo_idx = np.where(todo)[0]
+
+    for start in range(0, len(todo_idx), checkpoint_every):
+        block = todo_idx[start : start + checkpoint_every]
+        try:
+            df_coef, df_test = _fit_R_steps(
+                source_path, df_data_r, block, pool, warm_start
+            )
+            checkpoint.update(state, block, df_coef, df_test.pval)
+        except RRuntimeError:
+            # Find the failing step(s)
+            for i in block:
+                try:
+                    df_coef, df_test = _fit_R_steps(
+                        source_path, df_data_r, [i], pool, warm_start
+                    )
+                    checkpoint.update(state, [i], df_coef, df_test.pval)
+                except RRuntimeError as e:
+                    checkpoint.record_error(state, i, str(e))
+        checkpoint.save(checkpoint_file, state)
+
+    return checkpoint.to_dataframes(state, df_data_r.columns[4:].astype(np.float64))
+
+
+@cached(_files_regs_multiple)
 def run_R_test_regs_multiple(
-    source_path, df_data, save_path, save_name_add="", convert=True
+    source_path,
+    df_data,
+    save_path,
+    save_name_add="",
+    convert=True,
+    n_jobs=1,
+    pool=None,
+    adaptive=False,
+    coarse_step=10,
+    alpha=0.05,
+    alpha_margin=10,
+    warm_start=False,
+    checkpoint_file=None,
+    checkpoint_every=50,
+    retry_failed=False,
+    pairwise=False,
 ):
     """Run test over categories (regions) for multiple 'steps'
-    in R file and return pandas objects."""
+    in R file and return pandas objects.
+
+    If pairwise is True, a third dataframe with p-values of pairwise comparisons
+    between regions at each step is returned (see helpers.compute_pairs_sig_blocks).
+
+    If warm_start is True, the fit of each step starts from the random effects
+    estimated at the previous step (within each block of steps).
+
+    If a checkpoint_file (.npz) is given, results are saved to it every
+    checkpoint_every steps, and steps already in it are not fitted again, so that
+    an interrupted run can be resumed by calling the function again. Steps whose fit
+    fails are recorded (NaN results and error message in an 'error' column of the
+    test dataframe) instead of stopping the run; they are fitted again only if
+    retry_failed is True. Not available with adaptive.
+
+    If n_jobs > 1 (or a RWorkerPool is given), the steps are split in blocks
+    which are fitted by parallel R sessions, and merged back in step order.
+
+    If adaptive is True, only one every coarse_step steps is fitted at first,
+    then steps are bisected only where significance (p-value < alpha) switches
+    or where a p-value is within a factor alpha_margin of alpha. Steps not fitted
+    are filled by interpolation, and a 'fitted' column is added to the test
+    dataframe. Significance blocks are not guaranteed to be the same as in the
+    full run: a block narrower than coarse_step between two fitted steps on the
+    same side of alpha, with p-values both farther than a factor alpha_margin from
+    alpha, is missed. This does not happen when p-values change smoothly between
+    steps (as for ACF or PSD values), but a full run (adaptive=False) should
+    confirm the blocks to be reported. A warning is given if blocks narrower than
+    coarse_step are found."""
 
     # First, make the index a column
     df_data_r = df_data.reset_index()
+    n_steps = df_data_r.shape[1] - 4
+
+    if adaptive and checkpoint_file is not None:
+        raise ValueError("checkpoint_file cannot be used with adaptive.")
+    if pairwise and (adaptive or checkpoint_file is not None):
+        raise ValueError("pairwise cannot be used with adaptive or checkpoint_file.")
+
+    # Steps fitted in parallel, adaptively and/or with checkpoints
+    if n_jobs > 1 or pool is not None or adaptive or checkpoint_file is not None:
+        own_pool = pool is None and n_jobs > 1
+        if own_pool:
+            pool = RWorkerPool(source_path, n_workers=n_jobs)
+        try:
+            if adaptive:
+                df_list = _fit_R_steps_adaptive(
+                    source_path, df_data_r, coarse_step, alpha, alpha_margin, pool
+                )
+            elif checkpoint_file is not None:
+                df_list = _fit_R_steps_checkpoint(
+                    source_path,
+                    df_data_r,
+                    checkpoint_file,
+                    checkpoint_every,
+                    pool,
+                    warm_start,
+                    retry_failed,
+                )
+            else:
+                df_list = _fit_R_steps(
+                    source_path,
+                    df_data_r,
+                    np.arange(n_steps),
+                    pool,
+                    warm_start,
+                    pairwise,
+                )
+        finally:
+            if own_pool:
+                pool.close()
+
+        # Save as in R file
+        for df in df_list:
+            df.index = [str(j + 1) for j in range(n_steps)]
+        if save_name_add != "":
+            save_name_add = "_" + save_name_add
+        names = ["Coef", "Test", "Pairs"][: len(df_list)]
+        file_names = ["Test_coef", "Test_pval", "Test_pairs"][: len(df_list)]
+        for df, file_name in zip(df_list, file_names):
+            _write_csv_R(df, save_path + file_name + save_name_add + ".csv")
+
+        if convert:
+            return df_list
+
+        return ro.vectors.ListVector(
+            {name: _convert_pydf(df) for name, df in zip(names, df_list)}
+        )
 
     # Convert df_data to R object
     data = _convert_pydf(df_data_r)
 
     # Run test in R file
-    r = ro.r
-    r.source(source_path)
-    r_df_list = r.compute_test(data, save_path, save_name_add)
+    compute_test = _source_R(source_path)
+    r_df_list = compute_test(
+        data, save_path, save_name_add, warm_start=warm_start, pairwise=pairwise
+    )
 
     # Convert a list of R dataframes to pandas ones
     if convert:
@@ -86,6 +586,7 @@ def run_R_test_regs_multiple(
     return r_df_list
 
 
+@cached(_files_corr)
 def run_R_test_corr(
     source_path,
     df_data,
@@ -99,8 +600,7 @@ def run_R_test_corr(
     """Run test of correlations in R file and return pandas objects."""
 
     # First, make the index a 'pat' column
-    df_data.index = df_data.index.set_names(["pat"])
-    df_data_r = df_data.reset_index()
+    df_data_r = df_data.rename_axis("pat").reset_index()
 
     # Then, keep only pat, region, var_x and var_y varibles and re-name
     df_data_r = df_data_r.loc[:, ["pat", "region", var_x, var_y]]
@@ -110,9 +610,8 @@ def run_R_test_corr(
     data = _convert_pydf(df_data_r)
 
     # Run test in R file
-    r = ro.r
-    r.source(source_path)
-    r_df = r.compute_test(data, var_x, var_y, save_path, save_name_add, run_single)
+    compute_test = _source_R(source_path)
+    r_df = compute_test(data, var_x, var_y, save_path, save_name_add, run_single)
 
     # Convert a list of R dataframes to pandas ones
     if convert:
@@ -121,3 +620,111 @@ def run_R_test_corr(
 
     return r_df
 
+
+# Table with 'pat', 'region', 'x' and 'y' columns for one pair of variables
+_r_select_pair = ro.r(
+    "function(data, vx, vy) { d <- data[c('pat', 'region', vx, vy)]; "
+    "names(d) <- c('pat', 'region', 'x', 'y'); d }"
+)
+
+
+def _run_R_corr_pairs(
+    source_path,
+    df_data_r,
+    pairs,
+    save_path,
+    save_name_add="",
+    run_single=True,
+    convert=True,
+):
+    """Run correlation tests of several (var_x, var_y) pairs on the same data,
+    converted to R only once. Always returns a list of pandas dataframes."""
+
+    # Convert needed columns of df_data to R object
+    var_names = list(dict.fromkeys([v for pair in pairs for v in pair]))
+    data = _convert_pydf(df_data_r, ["pat", "region"] + var_names)
+
+    # Run tests in R file
+    compute_test = _source_R(source_path)
+    df_tests = []
+    for var_x, var_y in pairs:
+        r_df = compute_test(
+            _r_select_pair(data, var_x, var_y),
+            var_x,
+            var_y,
+            save_path,
+            save_name_add,
+            run_single,
+        )
+        df_tests.append(_convert_rdf(r_df))
+
+    return df_tests
+
+
+@cached(_files_corr_batch)
+def run_R_test_corr_batch(
+    source_path,
+    df_data,
+    pairs,
+    save_path,
+    save_name_add="",
+    run_single=True,
+    families=None,
+    correction="bonferroni",
+    n_jobs=1,
+    pool=None,
+):
+    """Run tests of correlations for several (var_x, var_y) pairs in R file
+    and return a single (long) pandas dataframe.
+
+    Data are converted to R once (once per worker if n_jobs > 1 or a RWorkerPool
+    is given, in which case pairs are split among the workers). Each test is saved
+    as in run_R_test_corr, and all of them in a 'Test_corr_batch' file.
+
+    The p-values are corrected across the pairs with the same label in families
+    (default: all pairs), separately for each Group (see helpers.stack_corr_tests),
+    with correction "bonferroni" (Default), "holm", "fdr_bh" or None.
+    """
+
+    # First, make the index a 'pat' column
+    df_data_r = df_data.rename_axis("pat").reset_index()
+    pairs = [tuple(pair) for pair in pairs]
+
+    if n_jobs > 1 or pool is not None:
+        own_pool = pool is None
+        if own_pool:
+            pool = RWorkerPool(source_path, n_workers=min(n_jobs, len(pairs)))
+        try:
+            blocks = [
+                b for b in np.array_split(np.arange(len(pairs)), pool.n_workers)
+                if len(b) > 0
+            ]
+            futures = [
+                pool.submit(
+                    "_run_R_corr_pairs",
+                    source_path,
+                    df_data_r,
+                    [pairs[i] for i in b],
+                    save_path,
+                    save_name_add,
+                    run_single,
+                )
+                for b in blocks
+            ]
+            df_tests = [df for f in futures for df in f.result()]
+        finally:
+            if own_pool:
+                pool.close()
+    else:
+        df_tests = _run_R_corr_pairs(
+            source_path, df_data_r, pairs, save_path, save_name_add, run_single
+        )
+
+    df_batch = stack_corr_tests(df_tests, pairs, families, correction)
+
+    # Save
+    if save_name_add != "":
+        save_name_add = "_" + save_name_add
+    _write_csv_R(df_batch, save_path + "Test_corr_batch" + save_name_add + ".csv")
+
+    return df_batch
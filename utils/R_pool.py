@@ -0,0 +1,112 @@
+"""
+Pool of long-lived R sessions to run the LME tests in parallel.
+
+Each worker is a separate Python process with its own embedded R, which sources
+the R files (and loads their packages) once at start-up. Jobs and results are
+exchanged with the workers as pandas objects through the pool's pipes.
+
+Scripts using the pool must protect their main code with
+'if __name__ == "__main__":', as workers are started by spawning new processes.
+
+Example
+-------
+>>> with RWorkerPool(["./LMEs/LME_corr.R"], n_workers=4) as pool:
+...     futures = [
+...         pool.run_R_test_corr(source_path, df_data, var_x, param, save_path)
+...         for var_x in ["mni_x", "mni_y", "mni_z"]
+...     ]
+...     df_tests = [f.result() for f in futures]
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+
+
+def _init_worker(source_paths):
+    """Start R in the worker and source all R files"""
+
+    from utils import R_convert
+
+    for source_path in source_paths:
+        R_convert._source_R(source_path)
+
+    # Attach packages used by the tests
+    R_convert.ro.r("suppressMessages({library(nlme); library(emmeans); library(MuMIn)})")
+
+
+def _ping():
+    """Empty job, used to start the workers"""
+
+    return True
+
+
+def _run_job(func_name, args, kwargs):
+    """Run one of the functions of R_convert in the worker"""
+
+    from utils import R_convert
+
+    return getattr(R_convert, func_name)(*args, **kwargs)
+
+
+class RWorkerPool:
+    """Pool of warm R workers running the functions of utils.R_convert.
+
+    Parameters
+    ----------
+    source_paths : list of str
+        R files to source in every worker at start-up.
+    n_workers : int
+        Number of worker processes (i.e. of R sessions). Default to 2.
+    """
+
+    def __init__(self, source_paths, n_workers=2):
+
+        if isinstance(source_paths, str):
+            source_paths = [source_paths]
+
+        self.source_paths = list(source_paths)
+        self.n_workers = n_workers
+        # Spawn (not fork) the workers: the parent already runs an embedded R
+        self._executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.source_paths,),
+        )
+
+        # Start all workers now, so that R start-up is not paid by the first jobs
+        wait([self._executor.submit(_ping) for _ in range(n_workers)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Shut down the R workers"""
+
+        self._executor.shutdown(wait=True)
+
+    def submit(self, func_name, *args, **kwargs):
+        """Submit a call to a function of utils.R_convert, return a Future"""
+
+        # Results go through the pipes as pandas objects
+        kwargs["convert"] = True
+
+        return self._executor.submit(_run_job, func_name, args, kwargs)
+
+    def run_R_test_regs(self, *args, **kwargs):
+        """Same as R_convert.run_R_test_regs, but run in a worker (returns a Future)."""
+
+        return self.submit("run_R_test_regs", *args, **kwargs)
+
+    def run_R_test_regs_multiple(self, *args, **kwargs):
+        """Same as R_convert.run_R_test_regs_multiple, but run in a worker (returns a Future)."""
+
+        return self.submit("run_R_test_regs_multiple", *args, **kwargs)
+
+    def run_R_test_corr(self, *args, **kwargs):
+        """Same as R_convert.run_R_test_corr, but run in a worker (returns a Future)."""
+
+        return self.submit("run_R_test_corr", *args, **kwargs)
@@ -0,0 +1,324 @@
+"""
+Hierarchical bootstrap of the region and correlation LMEs.
+
+Patients are resampled with replacement, then channels within each resampled
+patient (every resampled patient is a separate group of the random intercepts).
+Resamples are drawn as arrays of row indexes, and the per-patient sums of a
+chunk of resamples are accumulated with bincount, so that the LMEs of all
+resamples of the chunk are fitted together (see lme.fit_lme_batch), starting
+from the variance ratio of the original fit. Chunks are evaluated in parallel
+processes.
+
+Confidence intervals are percentile intervals of the bootstrap distributions.
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.contrasts import _contrast_matrix
+from utils.lme import (
+    Regions,
+    fit_lme,
+    fit_lme_batch,
+    region_means,
+    _batch_sums_regs,
+    _batch_sums_corr,
+    _design_regs,
+    _r_index,
+    _write_csv,
+    _format_save_name,
+)
+
+# Number of resamples evaluated together
+chunk_size = 250
+
+
+def resample_idx(starts, counts, n_boot, rng):
+    """Row indexes (of rows sorted by patient) of n_boot hierarchical resamples,
+    with the group (resample * M + resampled patient) of every row."""
+
+    M = len(starts)
+    pats = rng.integers(0, M, (n_boot, M)).ravel()
+    n_rows = counts[pats]
+    group = np.repeat(np.arange(n_boot * M), n_rows)
+    chan = (rng.random(n_rows.sum()) * np.repeat(n_rows, n_rows)).astype(np.intp)
+
+    return np.repeat(starts[pats], n_rows) + chan, group
+
+
+def _boot_chunk_regs(y, reg_idx, starts, counts, C, log_theta0, n_boot, seed):
+    """Fixed effects of the 'var ~ region' LMEs of a chunk of resamples"""
+
+    rng = np.random.default_rng(seed)
+    rows, group = resample_idx(starts, counts, n_boot, rng)
+    M, R = len(starts), C.shape[0]
+
+    # Counts and sums per (resample, patient, region)
+    cell = group * R + reg_idx[rows]
+    size = n_boot * M * R
+    n_c = np.bincount(cell, minlength=size).reshape(n_boot, M, R)
+    s_c = np.bincount(cell, y[rows], minlength=size).reshape(n_boot, M, R)
+    yty = np.bincount(group // M, y[rows] ** 2, minlength=n_boot)
+    sums = _batch_sums_regs(n_c, s_c, yty, C)
+
+    return fit_lme_batch(sums, log_theta0=log_theta0)["beta"]
+
+
+def _boot_chunk_corr(x, y, starts, counts, log_theta0, n_boot, seed):
+    """Fixed effects and marginal R2 of the 'y ~ x' LMEs of a chunk of resamples"""
+
+    rng = np.random.default_rng(seed)
+    rows, group = resample_idx(starts, counts, n_boot, rng)
+    M = len(starts)
+    x, y = x[rows], y[rows]
+    sums = _batch_sums_corr(x, y, group, n_boot, M)
+    fit = fit_lme_batch(sums, log_theta0=log_theta0)
+
+    # Marginal R2, with variance of fitted values from the sums
+    N, Sx, Sxx = sums["XtX"][:, 0, 0], sums["XtX"][:, 0, 1], sums["XtX"][:, 1, 1]
+    m = fit["beta"][:, 1]
+    var_fix = m ** 2 * (Sxx - Sx ** 2 / N) / (N - 1)
+    r2 = var_fix / (var_fix + fit["sigma2_pat"] + fit["sigma2"])
+
+    return np.column_stack([fit["beta"], r2])
+
+
+def _run_chunks(func, args, n_boot, n_jobs, seed):
+    """Evaluate func(*args, n, seed) on chunks of resamples, in n_jobs processes"""
+
+    n_chunks = int(np.ceil(n_boot / chunk_size))
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    sizes = [min(chunk_size, n_boot - i * chunk_size) for i in range(n_chunks)]
+    chunks = [args + (n, s) for n, s in zip(sizes, seeds)]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            res = list(executor.map(func, *zip(*chunks)))
+    else:
+        res = [func(*c) for c in chunks]
+
+    return np.concatenate(res)
+
+
+def sorted_groups(pat):
+    """Order of rows sorted by patient, first row and number of rows of patients"""
+
+    _, group_idx = np.unique(np.asarray(pat), return_inverse=True)
+    order = np.argsort(group_idx, kind="stable")
+    counts = np.bincount(group_idx)
+    starts = np.r_[0, np.cumsum(counts)[:-1]]
+
+    return order, group_idx, starts, counts
+
+
+def _ci_table(estimate, boot, names, ci):
+    """Estimates, bootstrap SE, percentile confidence intervals and two-sided
+    bootstrap p-values (of estimates being different from zero), bounded below
+    by 2 / (n + 1) for n valid resamples."""
+
+    valid = ~np.isnan(boot).any(axis=1)
+    boot = boot[valid]
+    n = len(boot)
+    q = 100 * np.array([(1 - ci) / 2, (1 + ci) / 2])
+    low, high = np.percentile(boot, q, axis=0)
+    k = np.sum(boot > 0, axis=0)
+
+    return pd.DataFrame(
+        {
+            "Coef": estimate,
+            "SE": boot.std(axis=0, ddof=1),
+            "ci_low": low,
+            "ci_high": high,
+            "pval": np.minimum(2 * (np.minimum(k, n - k) + 1) / (n + 1), 1),
+            "n_boot": valid.sum(),
+        },
+        index=pd.Index(names),
+    )
+
+
+def compute_boot_regs(
+    data,
+    var,
+    save_path,
+    save_name_add="",
+    n_boot=2000,
+    ci=0.95,
+    n_jobs=1,
+    seed=0,
+    regions=Regions,
+):
+    """Hierarchical bootstrap of the LME on 'categorical' data with 'region' factor
+    (as LME_regs_single.R).
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient, region and parameter data.
+    var : str
+        Name of the variable of interest in data.
+    save_path : str
+        Path where the csv files are saved.
+    save_name_add : str
+        Additional string to append to the csv file names.
+    n_boot : int
+        Number of resamples. Default to 2000.
+    ci : float
+        Level of the confidence intervals. Default to 0.95.
+    n_jobs : int
+        Number of processes evaluating the resamples. Default to 1.
+    seed : int
+        Seed of the random generator (results do not depend on n_jobs).
+    regions : list
+        Levels of the 'region' factor, the first is the reference.
+
+    Returns
+    -------
+    Results : list
+        - df_means : region means (Coef), bootstrap SE, confidence interval,
+          bootstrap p-value and number of valid resamples.
+        - df_diffs : same for the pairwise differences between regions
+          ("A - B", as emmeans). Resamples missing a region are discarded.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    data = data.dropna(subset=[var])
+    y = data[var].to_numpy(dtype=np.float64)
+    X = _design_regs(data["region"], regions)
+    order, group_idx, starts, counts = sorted_groups(data["pat"])
+
+    # Original fit
+    fit = fit_lme(X, y, group_idx)
+    log_theta0 = np.log(fit["sigma2_pat"][0] / fit["sigma2"][0])
+
+    C = _design_regs(regions, regions)
+    reg_idx = pd.Index(regions).get_indexer(np.asarray(data["region"]))[order]
+    args = (y[order], reg_idx, starts, counts, C, log_theta0)
+    beta = _run_chunks(_boot_chunk_regs, args, n_boot, n_jobs, seed)
+
+    # Region means and their pairwise differences
+    pairs, L = _contrast_matrix(len(regions))
+    df_means = _ci_table(region_means(fit)[0][0], beta @ C.T, regions, ci)
+    names = [regions[i] + " - " + regions[j] for i, j in pairs]
+    df_diffs = _ci_table(fit["beta"][0] @ L.T, beta @ L.T, names, ci)
+    df_means.index = df_means.index.rename("region")
+    df_diffs.index = df_diffs.index.rename("contrast")
+    df_means, df_diffs = df_means.reset_index(), df_diffs.reset_index()
+    df_means.index = _r_index(len(df_means))
+    df_diffs.index = _r_index(len(df_diffs))
+
+    # Save
+    _write_csv(df_means, save_path + "Boot_coef_" + var + save_name_add + ".csv")
+    _write_csv(df_diffs, save_path + "Boot_pairs_" + var + save_name_add + ".csv")
+
+    return [df_means, df_diffs]
+
+
+def compute_boot_corr(
+    data,
+    var_x,
+    var_y,
+    save_path,
+    save_name_add="",
+    run_single=True,
+    n_boot=2000,
+    ci=0.95,
+    n_jobs=1,
+    seed=0,
+    regions=Regions,
+):
+    """Hierarchical bootstrap of the LME regression with random intercepts
+    (as LME_corr.R).
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient (pat), region and parameters data (x and y).
+    var_x : str
+        Name of the independent variable (for file name).
+    var_y : str
+        Name of the dependent variable (for file name).
+    save_path : str
+        Path where the csv file is saved.
+    save_name_add : str
+        Additional string to append to the csv file name.
+    run_single : bool
+        If True, also bootstrap the regressions on single regions.
+    n_boot : int
+        Number of resamples (of every regression). Default to 2000.
+    ci : float
+        Level of the confidence intervals. Default to 0.95.
+    n_jobs : int
+        Number of processes evaluating the resamples. Default to 1.
+    seed : int
+        Seed of the random generator (results do not depend on n_jobs).
+    regions : list
+        Regions of the single regressions.
+
+    Returns
+    -------
+    df_boot : pandas DataFrame
+        Slope (m), intercept (q) and rho of the original fits (Coef), with bootstrap
+        SE, confidence intervals, p-values and number of valid resamples,
+        for every Group ("Overall" and single regions).
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    data = data.dropna(subset=["x", "y"])
+    Group = ["Overall"] + (list(regions) if run_single else [])
+    df_boot = []
+    for group in Group:
+        data_g = data if group == "Overall" else data[data["region"] == group]
+        x = data_g["x"].to_numpy(dtype=np.float64)
+        y = data_g["y"].to_numpy(dtype=np.float64)
+        order, group_idx, starts, counts = sorted_groups(data_g["pat"])
+
+        # Original fit
+        X = np.column_stack([np.ones(len(x)), x])
+        fit = fit_lme(X, y, group_idx)
+        log_theta0 = np.log(fit["sigma2_pat"][0] / fit["sigma2"][0])
+        var_fix = np.var(X @ fit["beta"][0], ddof=1)
+        r2 = var_fix / (var_fix + fit["sigma2_pat"][0] + fit["sigma2"][0])
+        m, q = fit["beta"][0, 1], fit["beta"][0, 0]
+
+        args = (x[order], y[order], starts, counts, log_theta0)
+        boot = _run_chunks(_boot_chunk_corr, args, n_boot, n_jobs, seed)
+        boot = np.column_stack(
+            [boot[:, 1], boot[:, 0], np.sqrt(boot[:, 2]) * np.sign(boot[:, 1])]
+        )
+        estimate = [m, q, np.sqrt(r2) * np.sign(m)]
+        df_boot.append(_ci_table(estimate, boot, ["m", "q", "rho"], ci))
+
+    df_boot = pd.concat(df_boot, keys=Group, names=["Group", "coef"]).reset_index()
+    df_boot.index = _r_index(len(df_boot))
+    _write_csv(
+        df_boot,
+        save_path + "Boot_corr_" + var_x + "_" + var_y + save_name_add + ".csv",
+    )
+
+    return df_boot
+
+
+def run_boot_regs(df_data, var, save_path, save_name_add="", **kwargs):
+    """Run hierarchical bootstrap of the region test and return pandas objects."""
+
+    # First, make the index a column
+    df_data_py = df_data.reset_index()
+
+    return compute_boot_regs(df_data_py, var, save_path, save_name_add, **kwargs)
+
+
+def run_boot_corr(df_data, var_x, var_y, save_path, save_name_add="", **kwargs):
+    """Run hierarchical bootstrap of correlations and return pandas objects."""
+
+    # First, make the index a 'pat' column
+    df_data_py = df_data.rename_axis("pat").reset_index()
+
+    # Then, keep only pat, region, var_x and var_y varibles and re-name
+    df_data_py = df_data_py.loc[:, ["pat", "region", var_x, var_y]]
+    df_data_py.columns = ["pat", "region", "x", "y"]
+
+    return compute_boot_corr(
+        df_data_py, var_x, var_y, save_path, save_name_add, **kwargs
+    )
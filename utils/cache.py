@@ -0,0 +1,189 @@
+"""
+On-disk cache of the results of the LME tests.
+
+Results are stored as pickle files named by a hash of everything that defines
+a test: the input data, the variables, the content of the R source file and
+the options. The csv files written by a test (listed by the decorator from its
+arguments) are stored with its results and written again when the results are
+loaded from the cache. When the cache grows above cache_max_size, the least
+recently used results are removed.
+"""
+
+import os
+import pickle
+import hashlib
+import inspect
+import functools
+import numpy as np
+import pandas as pd
+
+# Cache location and maximum size (in bytes)
+cache_dir = ".lme_cache"
+cache_max_size = 500 * 2 ** 20
+
+# Arguments which do not change the results
+_ignored_args = [
+    "convert",
+    "n_jobs",
+    "pool",
+    "cache",
+    "checkpoint_file",
+    "checkpoint_every",
+]
+
+
+def _hash_arg(h, name, value):
+    """Update hash object with one argument"""
+
+    h.update(name.encode())
+    if isinstance(value, pd.DataFrame):
+        h.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        h.update(repr(list(value.columns)).encode())
+        h.update(repr(list(value.index.names)).encode())
+        h.update(repr(list(value.dtypes.astype(str))).encode())
+    elif name == "source_path":
+        # Content of the R file, not its path
+        with open(value, "rb") as f:
+            h.update(f.read())
+    else:
+        h.update(repr(value).encode())
+
+
+def cache_key(func, *args, **kwargs):
+    """Hash of the function name and its (bound) arguments"""
+
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+
+    h = hashlib.sha256(func.__name__.encode())
+    for name, value in bound.arguments.items():
+        if name not in _ignored_args:
+            _hash_arg(h, name, value)
+
+    return h.hexdigest()
+
+
+def load(key):
+    """Load cached result, or None if not found"""
+
+    file_name = os.path.join(cache_dir, key + ".pkl")
+    try:
+        with open(file_name, "rb") as f:
+            result = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+    # Mark as recently used
+    os.utime(file_name)
+
+    return result
+
+
+def store(key, result):
+    """Store result in the cache and evict old results if needed"""
+
+    os.makedirs(cache_dir, exist_ok=True)
+    file_name = os.path.join(cache_dir, key + ".pkl")
+
+    # Write to a temporary file first, so that parallel workers never read half files
+    tmp_name = file_name + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_name, "wb") as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_name, file_name)
+
+    evict()
+
+
+def evict(max_size=None):
+    """Remove least recently used results until cache is below max_size"""
+
+    if max_size is None:
+        max_size = cache_max_size
+    if not os.path.isdir(cache_dir):
+        return
+
+    files = [
+        os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith(".pkl")
+    ]
+    stats = [os.stat(f) for f in files]
+    sizes = np.array([s.st_size for s in stats])
+    order = np.argsort([s.st_mtime for s in stats])
+
+    total = sizes.sum()
+    for i in order:
+        if total <= max_size:
+            break
+        os.remove(files[i])
+        total -= sizes[i]
+
+
+def clear():
+    """Remove all cached results"""
+
+    evict(max_size=0)
+
+
+def _mtimes(files):
+    """Modification times of files (None if missing)"""
+
+    return {f: os.stat(f).st_mtime_ns if os.path.isfile(f) else None for f in files}
+
+
+def _read_written(files, before):
+    """Content of the files written since their modification times before"""
+
+    written = {}
+    for f, mtime in _mtimes(files).items():
+        if mtime is not None and mtime != before[f]:
+            with open(f, "rb") as fr:
+                written[f] = fr.read()
+
+    return written
+
+
+def _write_files(files):
+    """Write again the files of a cached result"""
+
+    for f, content in files.items():
+        os.makedirs(os.path.dirname(f) or ".", exist_ok=True)
+        with open(f, "wb") as fw:
+            fw.write(content)
+
+
+def cached(output_files):
+    """Decorator caching the (pandas) results of a run_R_test_* function.
+
+    The decorated function accepts the additional argument cache (default True).
+    R objects (convert=False) are never cached.
+
+    output_files(arguments) lists the csv files the function may write, given the
+    dict of its (bound) arguments. Those written by the call are stored with the
+    results and written again on a cache hit, other files in the same directory
+    (e.g. of tests running in parallel) are never stored.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, cache=True, **kwargs):
+
+            bound = inspect.signature(func).bind(*args, **kwargs)
+            bound.apply_defaults()
+            if not cache or not bound.arguments.get("convert", True):
+                return func(*args, **kwargs)
+
+            key = cache_key(func, *args, **kwargs)
+            entry = load(key)
+            if isinstance(entry, dict) and "output_files" in entry:
+                _write_files(entry["output_files"])
+                return entry["result"]
+
+            files = output_files(bound.arguments)
+            before = _mtimes(files)
+            result = func(*args, **kwargs)
+            store(key, {"result": result, "output_files": _read_written(files, before)})
+
+            return result
+
+        return wrapper
+
+    return decorator
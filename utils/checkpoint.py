@@ -0,0 +1,103 @@
+"""
+Checkpoints of long per-step LME runs (e.g. run_R_test_regs_multiple on PSDs).
+
+Results of the steps are stored in a compressed npz file after every block of
+steps, together with a hash of the inputs. A run given an existing checkpoint
+skips the steps already done. Steps whose fit failed are recorded with their
+error message (and NaN results) instead of stopping the whole run.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+def new(key, n_steps):
+    """Empty checkpoint state for n_steps steps"""
+
+    return {
+        "key": np.array(key),
+        "done": np.zeros(n_steps, dtype=bool),
+        "failed": np.zeros(n_steps, dtype=bool),
+        "pval": np.full(n_steps, np.nan),
+        "errors": np.full(n_steps, "", dtype=object),
+    }
+
+
+def load(file_name, key):
+    """Load checkpoint state, or None if the file does not exist.
+
+    Raises a ValueError if the checkpoint was created with different inputs.
+    """
+
+    if not os.path.isfile(file_name):
+        return None
+
+    with np.load(file_name, allow_pickle=False) as f:
+        state = {k: f[k] for k in f.files}
+    if str(state["key"]) != key:
+        raise ValueError(
+            "Checkpoint " + file_name + " was created with different data or R file."
+        )
+    state["errors"] = state["errors"].astype(object)
+
+    return state
+
+
+def save(file_name, state):
+    """Save checkpoint state (atomically, through a temporary file)"""
+
+    dir_name = os.path.dirname(file_name)
+    if dir_name != "":
+        os.makedirs(dir_name, exist_ok=True)
+
+    arrays = dict(state)
+    arrays["errors"] = state["errors"].astype(str)
+    tmp_name = file_name + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_name, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_name, file_name)
+
+
+def update(state, steps_idx, df_coef, pval):
+    """Store results of the steps steps_idx (indexes among steps)"""
+
+    if "coef" not in state:
+        state["coef"] = np.full((len(state["done"]), df_coef.shape[1]), np.nan)
+        state["columns"] = np.array(df_coef.columns, dtype=str)
+
+    state["coef"][steps_idx] = df_coef.to_numpy(dtype=np.float64)
+    state["pval"][steps_idx] = np.asarray(pval, dtype=np.float64)
+    state["done"][steps_idx] = True
+    state["failed"][steps_idx] = False
+    state["errors"][steps_idx] = ""
+
+
+def record_error(state, step_idx, message):
+    """Mark one step as failed, with its error message"""
+
+    if "coef" in state:
+        state["coef"][step_idx] = np.nan
+    state["pval"][step_idx] = np.nan
+    state["done"][step_idx] = True
+    state["failed"][step_idx] = True
+    state["errors"][step_idx] = message.strip()
+
+
+def to_dataframes(state, steps):
+    """Coefficients and test dataframes (as in LME_regs_multiple.R),
+    with the error message of each step ("" if the fit succeeded)."""
+
+    n_steps = len(state["done"])
+    index = [str(i + 1) for i in range(n_steps)]
+
+    if "coef" in state:
+        df_coef = pd.DataFrame(state["coef"], index=index, columns=state["columns"])
+    else:
+        df_coef = pd.DataFrame(index=index)
+    df_test = pd.DataFrame(
+        {"steps": steps, "pval": state["pval"], "error": state["errors"].astype(str)},
+        index=index,
+    )
+
+    return [df_coef, df_test]
@@ -0,0 +1,142 @@
+"""
+Pairwise contrasts between the levels of a factor (e.g. regions) of fitted
+random-intercept LMEs (see utils.lme.fit_lme), as pairs(emmeans(LME, specs = "region")).
+
+With treatment coding, the mean of each level is a linear combination of the fixed
+effects, so all pairwise contrasts, their SE and t-ratios follow from beta and
+varFix with matrix products, for all fitted models at once. Tukey-adjusted p-values
+use a vectorized quadrature of the studentized range distribution.
+"""
+
+import numpy as np
+from scipy import stats
+from scipy.special import gammaln, ndtr
+
+# Gauss-Legendre quadrature of the studentized range distribution
+n_nodes_z = 96
+n_nodes_s = 64
+_nodes_z, _weights_z = np.polynomial.legendre.leggauss(n_nodes_z)
+_nodes_s, _weights_s = np.polynomial.legendre.leggauss(n_nodes_s)
+
+# Values of q evaluated together
+chunk_size = 20000
+
+
+def _range_cdf(w, k):
+    """CDF of the range of k standard normal variables, at w (any shape)"""
+
+    # Integral over z in [-8, 8]
+    z = 8 * _nodes_z
+    a = 8 * _weights_z * stats.norm.pdf(z)
+    diff = ndtr(z) - ndtr(z - w[..., None])
+
+    return k * np.sum(a * np.maximum(diff, 0) ** (k - 1), axis=-1)
+
+
+def ptukey_sf(q, k, df):
+    """Survival function of the studentized range distribution (vectorized).
+
+    Same as scipy.stats.studentized_range.sf(q, k, df), but evaluated on all
+    values of q at once. df can be a scalar or have the same shape as q.
+    """
+
+    q = np.asarray(q, dtype=np.float64)
+    df = np.broadcast_to(np.asarray(df, dtype=np.float64), q.shape)
+    q_flat, df_flat = q.ravel(), df.ravel()
+    sf = np.empty(q_flat.shape)
+
+    for nu in np.unique(df_flat):
+        idx = np.where(df_flat == nu)[0]
+
+        # Integral over s = sqrt(chi2(nu) / nu), around its mode
+        low = max(0.0, 1 - 8 / np.sqrt(nu))
+        high = 1 + 8 / np.sqrt(nu)
+        s = (high - low) / 2 * _nodes_s + (high + low) / 2
+        log_f = (
+            nu / 2 * np.log(nu)
+            - gammaln(nu / 2)
+            - (nu / 2 - 1) * np.log(2)
+            + (nu - 1) * np.log(s)
+            - nu * s ** 2 / 2
+        )
+        a = (high - low) / 2 * _weights_s * np.exp(log_f)
+
+        for start in range(0, len(idx), chunk_size):
+            i = idx[start : start + chunk_size]
+            cdf = _range_cdf(q_flat[i, None] * s[None, :], k) @ a
+            sf[i] = np.clip(1 - cdf, 0, 1)
+
+    return sf.reshape(q.shape)
+
+
+def _contrast_matrix(k):
+    """Pairwise contrasts of level means, as combinations of treatment-coded effects"""
+
+    # Level means as linear combinations of the fixed effects
+    C = np.eye(k)
+    C[:, 0] = 1.0
+    pairs = [(i, j) for i in range(k) for j in range(i + 1, k)]
+
+    return pairs, np.stack([C[i] - C[j] for i, j in pairs])
+
+
+def pairwise_contrasts(fits, levels, adjust="tukey"):
+    """Pairwise contrasts between factor levels of one or many LME fits.
+
+    Parameters
+    ----------
+    fits : dict or list of dict
+        Fit(s) returned by utils.lme.fit_lme, with treatment coding of the factor
+        in the first len(levels) columns of the design matrix.
+    levels : list
+        Levels of the factor, the first is the reference.
+    adjust : str
+        P-value adjustment over the pairs: "tukey" (Default, as emmeans),
+        "bonferroni" or "none".
+
+    Returns
+    -------
+    contrasts : dict
+        Names of the contrasts ("A - B", as emmeans), and arrays with one row per
+        fitted column (all fits stacked) and one column per contrast: estimates,
+        SE, t-ratios and p-values, with degrees of freedom of each row (df).
+    """
+
+    if isinstance(fits, dict):
+        fits = [fits]
+
+    k = len(levels)
+    pairs, L = _contrast_matrix(k)
+    L = np.hstack([L, np.zeros((len(pairs), fits[0]["beta"].shape[1] - k))])
+
+    # All fits stacked
+    est = np.concatenate([fit["beta"] @ L.T for fit in fits])
+    se = np.sqrt(
+        np.concatenate(
+            [np.einsum("cp,spq,cq->sc", L, fit["varFix"], L) for fit in fits]
+        )
+    )
+    # Containment degrees of freedom of the factor effects
+    df = np.concatenate(
+        [np.full(fit["beta"].shape[0], fit["df"][1:k].min()) for fit in fits]
+    )
+    t_ratio = est / se
+
+    if adjust == "tukey":
+        pval = ptukey_sf(np.sqrt(2) * np.abs(t_ratio), k, df[:, None])
+    elif adjust == "bonferroni":
+        pval = 2 * stats.t.sf(np.abs(t_ratio), df[:, None])
+        pval = np.minimum(pval * len(pairs), 1)
+    elif adjust == "none":
+        pval = 2 * stats.t.sf(np.abs(t_ratio), df[:, None])
+    else:
+        raise ValueError("adjust must be one of 'tukey', 'bonferroni' or 'none'.")
+
+    return {
+        "names": [levels[i] + " - " + levels[j] for i, j in pairs],
+        "estimate": est,
+        "SE": se,
+        "df": df,
+        "t_ratio": t_ratio,
+        "pval": pval,
+    }
@@ -0,0 +1,163 @@
+"""
+Functional random-intercept model for 'sequential' data (e.g. ACF or PSD profiles).
+
+Instead of fitting one LME per step, each channel's profile is projected on a
+B-spline basis over the steps (or their log, e.g. for frequencies). The basis
+coefficients are rotated onto the principal axes of their residual covariance
+and a random-intercept LME ('coefficient ~ region, random = ~1 | pat') is fitted
+to every rotated coefficient, assuming they are independent. Region effects and
+their covariance are then mapped back on the steps.
+
+The cost grows with the number of basis functions instead of the number of steps,
+and significance is corrected for the dimension of the model (Scheffe-type bound)
+instead of the number of steps.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.interpolate import BSpline
+
+from utils.lme import (
+    Regions,
+    fit_lme,
+    wald_test,
+    region_means,
+    _design_regs,
+    _r_index,
+    _write_csv,
+    _format_save_name,
+)
+
+
+def bspline_basis(x, n_basis=20, degree=3):
+    """B-spline basis with equally spaced knots over the range of x.
+
+    Returns a (len(x), n_basis) array.
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    n_inner = n_basis - degree - 1
+    if n_inner < 0:
+        raise ValueError("n_basis must be larger than degree.")
+
+    knots = np.r_[
+        [x.min()] * (degree + 1),
+        np.linspace(x.min(), x.max(), n_inner + 2)[1:-1],
+        [x.max()] * (degree + 1),
+    ]
+
+    return BSpline(knots, np.eye(n_basis), degree, extrapolate=False)(x)
+
+
+def compute_test_functional(
+    data,
+    save_path,
+    save_name_add="",
+    n_basis=20,
+    degree=3,
+    log_steps=False,
+    alpha=0.05,
+    regions=Regions,
+):
+    """Compute functional LME test on 'sequential' data.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient, channel, resp, region and one column per step.
+    save_path : str
+        Path where the csv files are saved.
+    save_name_add : str
+        Additional string to append to the csv file names.
+    n_basis : int
+        Number of B-spline basis functions. Default to 20.
+    degree : int
+        Degree of the B-splines. Default to 3 (cubic).
+    log_steps : bool
+        If True, basis is built over log10 of the steps (e.g. for frequencies).
+    alpha : float
+        Level of the pointwise bands.
+    regions : list
+        Levels of the 'region' factor, the first is the reference.
+
+    Returns
+    -------
+    Results : list
+        A list with three dataframes:
+          - df_coef : region mean curves and SE (as in LME_regs_multiple.R),
+            with pointwise (1 - alpha) bands, for each step.
+          - df_test : pointwise F-values of the region effect and p-values,
+            corrected for the dimension of the model.
+          - df_overall : test of the region effect on the whole curves.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    # Steps are all columns after pat, chan, resp and region
+    steps = data.columns[4:].astype(np.float64)
+    x = np.log10(steps) if log_steps else steps
+    Y = data.iloc[:, 4:].to_numpy(dtype=np.float64)
+    X = _design_regs(data["region"], regions)
+
+    # Project curves on basis
+    B = bspline_basis(x, n_basis, degree)
+    coef = np.linalg.lstsq(B, Y.T, rcond=None)[0].T
+
+    # Rotate coefficients on principal axes of residual covariance
+    resid = coef - X @ np.linalg.lstsq(X, coef, rcond=None)[0]
+    _, Phi = np.linalg.eigh(np.cov(resid, rowvar=False))
+    fit_comp = fit_lme(X, coef @ Phi, data["pat"])
+
+    # Back on the steps
+    A = B @ Phi
+    fit = {
+        "beta": A @ fit_comp["beta"],
+        "varFix": np.einsum("sc,cpq->spq", A ** 2, fit_comp["varFix"]),
+        "df": fit_comp["df"],
+    }
+
+    # Region mean curves with SE and pointwise bands
+    means, sems = region_means(fit)
+    z = stats.norm.ppf(1 - alpha / 2)
+    df_coef = pd.DataFrame(
+        np.hstack([means, sems, means - z * sems, means + z * sems]),
+        index=_r_index(len(steps)),
+        columns=[r + "_" + c for c in ["mean", "sem", "low", "high"] for r in regions],
+    )
+
+    # Pointwise test, corrected over all linear combinations of the model (Scheffe)
+    cols = np.arange(1, len(regions))
+    q = len(cols)
+    F, _, dendf, _ = wald_test(fit, cols)
+    pval = stats.f.sf(F / n_basis, q * n_basis, dendf)
+    df_test = pd.DataFrame({"steps": steps, "F": F, "pval": pval}, index=_r_index(len(steps)))
+
+    # Overall test on the whole curves
+    F_comp = wald_test(fit_comp, cols)[0]
+    F_all = F_comp.sum() / n_basis
+    df_overall = pd.DataFrame(
+        {
+            "statistics": [F_all],
+            "numdf": [float(q * n_basis)],
+            "dendf": [float(dendf)],
+            "pvalue": [stats.f.sf(F_all, q * n_basis, dendf)],
+        },
+        index=_r_index(1),
+    )
+
+    # Save
+    _write_csv(df_coef, save_path + "Test_fun_coef" + save_name_add + ".csv")
+    _write_csv(df_test, save_path + "Test_fun_pval" + save_name_add + ".csv")
+    _write_csv(df_overall, save_path + "Test_fun_overall" + save_name_add + ".csv")
+
+    return [df_coef, df_test, df_overall]
+
+
+def run_test_functional(df_data, save_path, save_name_add="", **kwargs):
+    """Run functional test over categories (regions) and return pandas objects."""
+
+    # First, make the index a column
+    df_data_py = df_data.reset_index()
+
+    return compute_test_functional(df_data_py, save_path, save_name_add, **kwargs)
@@ -159,3 +159,84 @@ def compute_sig_blocks(pvals, alpha):
             )
 
     return points_sign_blocks
+
+
+def compute_pairs_sig_blocks(df_pairs, alpha):
+    """Compute endpoints of blocks of significance of each pairwise comparison
+    (columns of df_pairs other than 'steps'). Returns a dict."""
+
+    return {
+        pair: compute_sig_blocks(df_pairs[pair].to_numpy(), alpha)
+        for pair in df_pairs.columns
+        if pair != "steps"
+    }
+
+
+def adjust_pvals(pvals, method="bonferroni"):
+    """Adjust p-values for multiple comparisons.
+
+    method can be "bonferroni", "holm", "fdr_bh" (Benjamini-Hochberg) or None.
+    """
+
+    pvals = np.asarray(pvals, dtype=np.float64)
+    n = len(pvals)
+
+    if method is None or n == 0:
+        return pvals.copy()
+    if method == "bonferroni":
+        return np.minimum(pvals * n, 1)
+
+    order = np.argsort(pvals)
+    p_sorted = pvals[order]
+    if method == "holm":
+        p_adj = np.maximum.accumulate(p_sorted * (n - np.arange(n)))
+    elif method == "fdr_bh":
+        p_adj = np.minimum.accumulate((p_sorted * n / np.arange(1, n + 1))[::-1])[::-1]
+    else:
+        raise ValueError("method must be one of 'bonferroni', 'holm', 'fdr_bh' or None.")
+    pvals_adj = np.empty(n)
+    pvals_adj[order] = np.minimum(p_adj, 1)
+
+    return pvals_adj
+
+
+def stack_corr_tests(df_tests, pairs, families=None, correction="bonferroni"):
+    """Stack correlation tests of several (var_x, var_y) pairs in a single dataframe,
+    correcting p-values across pairs of the same family, separately for each Group.
+
+    The p-value of each single test (as in LME_corr.R) is kept as 'pval_pair'.
+    """
+
+    if families is None:
+        families = ["all"] * len(pairs)
+
+    df_batch = []
+    for df_test, (var_x, var_y), family in zip(df_tests, pairs, families):
+        df_test = df_test.copy()
+        df_test.insert(0, "family", family)
+        df_test.insert(0, "var_y", var_y)
+        df_test.insert(0, "var_x", var_x)
+        df_batch.append(df_test)
+    df_batch = pd.concat(df_batch, ignore_index=True)
+
+    df_batch["pval_pair"] = df_batch["pval"]
+    for _, idx in df_batch.groupby(["family", "Group"], sort=False).groups.items():
+        df_batch.loc[idx, "pval"] = adjust_pvals(
+            df_batch.loc[idx, "pval_pair"], correction
+        )
+    df_batch.index = [str(i + 1) for i in range(len(df_batch))]
+
+    return df_batch
+
+
+def stack_regs_tests(results, keys):
+    """Stack [df_coef, df_test] results of region tests in two dataframes,
+    indexed by (variable, subset, row) given the (variable, subset) keys."""
+
+    # Sort by keys only, so that rows of each test keep their order
+    return [
+        pd.concat(
+            [res[i] for res in results], keys=keys, names=["variable", "subset", None]
+        ).sort_index(level=[0, 1], sort_remaining=False)
+        for i in range(2)
+    ]
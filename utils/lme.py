@@ -0,0 +1,1198 @@
+"""
+Collection of functions to fit random-intercept Linear Mixed-Effects models
+directly in Python (no R needed).
+
+The models are the same as the ones in the LMEs folder, i.e.
+'var ~ region, random = ~1 | pat' and 'y ~ x, random = ~1 | pat', fitted with REML.
+All the 'steps' (e.g. lags or frequencies) sharing the same design are fitted together.
+
+The run_test_* functions take the same arguments (without source_path) and return
+the same dataframes as the run_R_test_* functions in R_convert, so that the
+backend of a script is selected by its import.
+"""
+
+import csv
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from utils.helpers import (
+    stack_corr_tests,
+    stack_regs_tests,
+    adjust_pvals,
+    compute_sig_blocks,
+    get_resp_params,
+)
+from utils.contrasts import pairwise_contrasts
+
+# Levels of the "Region" factor
+Regions = ["CTX", "ENT", "HIP", "AMY"]
+
+# Search space of the log-ratio between random intercept and residual variances
+log_theta_grid = np.arange(-15, 10.5, 0.5)
+golden_tol = 1e-8
+
+# Newton search (with numerical derivatives) of the log-ratio
+newton_h = 1e-3
+newton_tol = 1e-7
+newton_crit_tol = 1e-9  # on the criterion, to stop on flat ends (theta -> 0)
+newton_max_iter = 100
+
+
+###
+# Helpers
+###
+
+
+def _r_index(n):
+    """Row names as given by a converted R dataframe"""
+
+    return [str(i + 1) for i in range(n)]
+
+
+def _write_csv(df, save_file):
+    """Save dataframe with the same format of R's write.csv"""
+
+    df.to_csv(save_file, quoting=csv.QUOTE_NONNUMERIC, na_rep="NA")
+
+
+def _format_save_name(save_name_add):
+    """Format additional string for saved file names"""
+
+    if save_name_add != "":
+        save_name_add = "_" + save_name_add
+
+    return save_name_add
+
+
+def _design_regs(region, regions):
+    """Design matrix of 'region' factor with treatment contrasts."""
+
+    region = np.asarray(region)
+    if not np.isin(region, regions).all():
+        raise ValueError("Unknown levels in 'region': all must be in " + str(regions))
+
+    X = np.zeros((len(region), len(regions)))
+    X[:, 0] = 1.0
+    for i, reg in enumerate(regions[1:]):
+        X[:, i + 1] = region == reg
+    if (X[:, 1:].sum(axis=0) == 0).any():
+        raise ValueError("Every level of 'region' needs at least one observation.")
+
+    return X
+
+
+def _group_sums(X, Y, groups):
+    """Per-group sums needed to compute the (REML) likelihood.
+
+    Parameters
+    ----------
+    X : ndarray
+        (N, p) design matrix.
+    Y : ndarray
+        (N, S) matrix of responses, one column per step.
+    groups : array-like
+        (N,) group (patient) of every observation.
+
+    Returns
+    -------
+    sums : dict
+        Number of observations per group (n), group sums of X (sX) and Y (sY),
+        and the cross-products XtX, XtY and yty.
+    """
+
+    _, idx = np.unique(np.asarray(groups), return_inverse=True)
+    M = idx.max() + 1
+
+    sums = {
+        "n": np.bincount(idx, minlength=M).astype(float),
+        "sX": np.zeros((M, X.shape[1])),
+        "sY": np.zeros((M, Y.shape[1])),
+        "XtX": X.T @ X,
+        "XtY": X.T @ Y,
+        "yty": np.einsum("ns,ns->s", Y, Y),
+    }
+    np.add.at(sums["sX"], idx, X)
+    np.add.at(sums["sY"], idx, Y)
+
+    return sums
+
+
+def _reml_terms(log_theta, sums):
+    """Profiled REML criterion and GLS terms for each step.
+
+    With theta = sigma_pat^2 / sigma^2, the marginal covariance of a group
+    with n observations is sigma^2 * (I + theta * J) and its inverse is
+    I - w * J, with w = theta / (1 + n * theta).
+    """
+
+    theta = np.exp(log_theta)
+    n, sX, sY = sums["n"], sums["sX"], sums["sY"]
+    N = n.sum()
+    p = sX.shape[1]
+
+    w = theta[:, None] / (1 + theta[:, None] * n[None, :])  # (S, M)
+    A = sums["XtX"][None] - np.einsum("sm,mp,mq->spq", w, sX, sX)
+    b = sums["XtY"].T - np.einsum("sm,mp,ms->sp", w, sX, sY)
+    c = sums["yty"] - np.einsum("sm,ms->s", w, sY ** 2)
+
+    beta = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+    rss = c - np.einsum("sp,sp->s", b, beta)
+    _, logdet_A = np.linalg.slogdet(A)
+    logdet_V = np.log1p(theta[:, None] * n[None, :]).sum(axis=1)
+
+    # Criterion to minimize (-2 * REML log-likelihood, without constants)
+    crit = logdet_V + logdet_A + (N - p) * np.log(rss)
+
+    return crit, A, beta, rss
+
+
+def _reml_terms_batch(log_theta, sums):
+    """Profiled REML criterion and GLS terms of a batch of models with a single
+    response, each with its own sums (leading axis, e.g. resamples or leave-outs).
+    Groups with no observations (n = 0) do not contribute.
+    """
+
+    theta = np.exp(log_theta)
+    n, sX, sY = sums["n"], sums["sX"], sums["sY"]
+    N = n.sum(axis=1)
+    p = sX.shape[2]
+
+    w = theta[:, None] / (1 + theta[:, None] * n)  # (L, M)
+    A = sums["XtX"] - np.einsum("lm,lmp,lmq->lpq", w, sX, sX)
+    b = sums["XtY"] - np.einsum("lm,lmp,lm->lp", w, sX, sY)
+    c = sums["yty"] - np.einsum("lm,lm->l", w, sY ** 2)
+
+    beta = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+    rss = c - np.einsum("lp,lp->l", b, beta)
+    _, logdet_A = np.linalg.slogdet(A)
+    logdet_V = np.log1p(theta[:, None] * n).sum(axis=1)
+
+    crit = logdet_V + logdet_A + (N - p) * np.log(rss)
+
+    return crit, A, beta, rss
+
+
+def _batch_sums_regs(n_c, s_c, yty, C):
+    """Per-group sums of a batch of 'var ~ region' models, from counts (n_c) and sums
+    (s_c) per (model, group, region), (L, M, R), sums of squares (yty, (L,)) and
+    rows C of the design matrix of each region."""
+
+    return {
+        "n": n_c.sum(axis=2).astype(np.float64),
+        "sX": n_c @ C,
+        "sY": s_c.sum(axis=2),
+        "XtX": np.einsum("lr,rp,rq->lpq", n_c.sum(axis=1), C, C),
+        "XtY": s_c.sum(axis=1) @ C,
+        "yty": yty,
+    }
+
+
+def _batch_sums_corr(x, y, group, L, M):
+    """Per-group sums of a batch of 'y ~ x' models, from observations (x, y) of
+    group 'group' (model * M + group of the model)."""
+
+    def _sum(w):
+        return np.bincount(group, w, minlength=L * M).reshape(L, M)
+
+    n = _sum(None).astype(np.float64)
+    sx, sy, sxx, sxy = _sum(x), _sum(y), _sum(x * x), _sum(x * y)
+    N, Sx, Sxx = n.sum(axis=1), sx.sum(axis=1), sxx.sum(axis=1)
+
+    return {
+        "n": n,
+        "sX": np.stack([n, sx], axis=2),
+        "sY": sy,
+        "XtX": np.stack([np.stack([N, Sx], 1), np.stack([Sx, Sxx], 1)], 1),
+        "XtY": np.stack([sy.sum(axis=1), sxy.sum(axis=1)], 1),
+        "yty": _sum(y * y).sum(axis=1),
+    }
+
+
+def _sub_sums(sums, idx):
+    """Per-group sums of a subset of the steps"""
+
+    sub = dict(sums)
+    sub["sY"] = sums["sY"][:, idx]
+    sub["XtY"] = sums["XtY"][:, idx]
+    sub["yty"] = sums["yty"][idx]
+
+    return sub
+
+
+def _optimize_theta(sums, S):
+    """Find the REML estimate of the log variance ratio of every step.
+
+    A grid search brackets the optimum, which is then refined
+    with a golden-section search, simultaneously on all steps.
+    Returns estimates, number of iterations and of criterion evaluations.
+    """
+
+    # Coarse grid
+    crit_grid = np.stack(
+        [_reml_terms(np.full(S, g), sums)[0] for g in log_theta_grid], axis=1
+    )
+    i_min = np.argmin(crit_grid, axis=1)
+    low = log_theta_grid[np.maximum(i_min - 1, 0)]
+    high = log_theta_grid[np.minimum(i_min + 1, len(log_theta_grid) - 1)]
+
+    # Golden-section search
+    gr = (np.sqrt(5) - 1) / 2
+    x1 = high - gr * (high - low)
+    x2 = low + gr * (high - low)
+    f1 = _reml_terms(x1, sums)[0]
+    f2 = _reml_terms(x2, sums)[0]
+    n_iter = 0
+    while np.max(high - low) > golden_tol:
+        n_iter += 1
+        left = f1 < f2
+        high = np.where(left, x2, high)
+        low = np.where(left, low, x1)
+        x2_new = np.where(left, x1, low + gr * (high - low))
+        x1_new = np.where(left, high - gr * (high - low), x2)
+        f_new = _reml_terms(np.where(left, x1_new, x2_new), sums)[0]
+        f1, f2 = np.where(left, f_new, f2), np.where(left, f1, f_new)
+        x1, x2 = x1_new, x2_new
+
+    n_eval = len(log_theta_grid) + 2 + n_iter
+
+    return (low + high) / 2, np.full(S, n_iter), np.full(S, n_eval)
+
+
+def _newton_theta(sums, log_theta0, terms=_reml_terms):
+    """Newton search of the REML estimates of the log variance ratios, from log_theta0.
+
+    Derivatives are computed numerically, and steps are halved until the criterion
+    decreases. Returns estimates, number of iterations and of criterion evaluations.
+    The criterion is computed by terms (given log-ratios and sums).
+    """
+
+    low, high = log_theta_grid[0], log_theta_grid[-1]
+    x = np.clip(np.asarray(log_theta0, dtype=np.float64), low, high)
+    h = newton_h
+    n_iter = np.zeros(len(x), dtype=int)
+    n_eval = np.ones(len(x), dtype=int)
+    active = np.ones(len(x), dtype=bool)
+
+    f0 = terms(x, sums)[0]
+    for _ in range(newton_max_iter):
+        fp = terms(x + h, sums)[0]
+        fm = terms(x - h, sums)[0]
+        g = (fp - fm) / (2 * h)
+        H = (fp - 2 * f0 + fm) / h ** 2
+        d = np.clip(np.where(H > 0, -g / np.where(H > 0, H, 1), -np.sign(g)), -2, 2)
+        d = np.clip(x + d, low, high) - x
+        x_new = x + d
+        f_new = terms(x_new, sums)[0]
+        n_eval[active] += 3
+
+        # Backtracking
+        worse = active & (f_new > f0) & (np.abs(d) > newton_tol)
+        while worse.any():
+            d = np.where(worse, d / 2, d)
+            x_new = np.where(worse, x + d, x_new)
+            f_new = np.where(worse, terms(x_new, sums)[0], f_new)
+            n_eval[worse] += 1
+            worse = worse & (f_new > f0) & (np.abs(d) > newton_tol)
+
+        accept = active & (f_new <= f0)
+        x = np.where(accept, x_new, x)
+        decrease = np.where(accept, f0 - f_new, 0)
+        f0 = np.where(accept, f_new, f0)
+        n_iter[active] += 1
+        active = active & (np.abs(d) > newton_tol) & (decrease > newton_crit_tol)
+        if not active.any():
+            break
+
+    return x, n_iter, n_eval
+
+
+def _warm_theta(sums, S):
+    """Newton search of the REML estimates step by step, each
+    starting from the estimate of the previous step."""
+
+    log_theta = np.zeros(S)
+    n_iter = np.zeros(S, dtype=int)
+    n_eval = np.zeros(S, dtype=int)
+
+    start = 0.0
+    for s in range(S):
+        res = _newton_theta(_sub_sums(sums, [s]), [start])
+        log_theta[s], n_iter[s], n_eval[s] = res[0][0], res[1][0], res[2][0]
+        start = log_theta[s]
+
+    return log_theta, n_iter, n_eval
+
+
+def _fix_df(X, groups):
+    """Denominator degrees of freedom of each fixed effect, as computed by nlme.
+
+    Columns of X varying within at least one group are estimated
+    at the residual level, the other ones at the group level.
+    """
+
+    groups = np.asarray(groups)
+    _, idx = np.unique(groups, return_inverse=True)
+    M = idx.max() + 1
+    N = X.shape[0]
+
+    inner = np.zeros(X.shape[1], dtype=bool)
+    for j in range(X.shape[1]):
+        col_min = np.full(M, np.inf)
+        col_max = np.full(M, -np.inf)
+        np.minimum.at(col_min, idx, X[:, j])
+        np.maximum.at(col_max, idx, X[:, j])
+        inner[j] = np.any(col_max - col_min > 0)
+
+    df_groups = M - np.sum(~inner)
+    df_resid = N - M - np.sum(inner)
+
+    return np.where(inner, df_resid, df_groups)
+
+
+def fit_lme(X, Y, groups, optimizer="grid"):
+    """Fit random-intercept LMEs with REML, one for every column of Y.
+
+    Parameters
+    ----------
+    X : ndarray
+        (N, p) design matrix, shared by all models.
+    Y : ndarray
+        (N, S) or (N,) responses.
+    groups : array-like
+        (N,) grouping factor of the random intercepts.
+    optimizer : str
+        Search of the variance ratios: "grid" (Default) for a grid and golden-section
+        search on all columns at once, "newton" for a Newton search on all columns
+        at once, "warm" for a Newton search on one column after the other,
+        each starting from the estimate of the previous column.
+
+    Returns
+    -------
+    fit : dict
+        Fixed effects (beta, (S, p)), their covariance (varFix, (S, p, p)),
+        residual and random intercept variances (sigma2, sigma2_pat, (S,)),
+        denominator degrees of freedom of the fixed effects (df, (p,)),
+        and number of optimizer iterations and criterion evaluations (n_iter, n_eval, (S,)).
+    """
+
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        Y = Y[:, None]
+    if np.isnan(Y).any() or np.isnan(X).any():
+        raise ValueError("missing values in object")
+
+    sums = _group_sums(X, Y, groups)
+
+    return fit_lme_sums(sums, _fix_df(X, groups), optimizer)
+
+
+def fit_lme_sums(sums, df, optimizer="grid"):
+    """Fit random-intercept LMEs with REML from per-group sums only.
+
+    Parameters
+    ----------
+    sums : dict
+        Per-group sums, as returned by _group_sums (groups without
+        observations do not contribute).
+    df : ndarray
+        (p,) denominator degrees of freedom of the fixed effects.
+    optimizer : str
+        Search of the variance ratios (see fit_lme).
+
+    Returns
+    -------
+    fit : dict
+        Same as fit_lme.
+    """
+
+    S = sums["sY"].shape[1]
+    N = sums["n"].sum()
+    p = sums["sX"].shape[1]
+
+    if optimizer == "grid":
+        log_theta, n_iter, n_eval = _optimize_theta(sums, S)
+    elif optimizer == "newton":
+        log_theta, n_iter, n_eval = _newton_theta(sums, np.zeros(S))
+    elif optimizer == "warm":
+        log_theta, n_iter, n_eval = _warm_theta(sums, S)
+    else:
+        raise ValueError("optimizer must be one of 'grid', 'newton' or 'warm'.")
+    _, A, beta, rss = _reml_terms(log_theta, sums)
+    sigma2 = rss / (N - p)
+
+    fit = {
+        "beta": beta,
+        "varFix": sigma2[:, None, None] * np.linalg.inv(A),
+        "sigma2": sigma2,
+        "sigma2_pat": sigma2 * np.exp(log_theta),
+        "df": np.asarray(df),
+        "n_iter": n_iter,
+        "n_eval": n_eval,
+    }
+
+    return fit
+
+
+def fit_lme_batch(sums, df=None, log_theta0=0.0):
+    """Fit a batch of random-intercept LMEs with a single response each, with REML,
+    from per-group sums with a leading batch axis (see _reml_terms_batch).
+
+    Parameters
+    ----------
+    sums : dict
+        Per-group sums of every model, as returned by _batch_sums_regs or
+        _batch_sums_corr.
+    df : ndarray
+        (p,) or (L, p) denominator degrees of freedom of the fixed effects.
+        Default to NaN.
+    log_theta0 : float or ndarray
+        Starting log variance ratio(s) of the Newton search.
+
+    Returns
+    -------
+    fit : dict
+        Same as fit_lme, with one row per model and df of shape (L, p).
+        Models with a singular design (e.g. a missing region) are NaN.
+    """
+
+    A = sums["XtX"]
+    L, p = A.shape[0], A.shape[1]
+    valid = np.linalg.matrix_rank(A) == p
+    log_theta0 = np.broadcast_to(np.asarray(log_theta0, dtype=np.float64), (L,))
+    if df is None:
+        df = np.full(p, np.nan)
+
+    fit = {
+        "beta": np.full((L, p), np.nan),
+        "varFix": np.full((L, p, p), np.nan),
+        "sigma2": np.full(L, np.nan),
+        "sigma2_pat": np.full(L, np.nan),
+        "df": np.broadcast_to(np.asarray(df, dtype=np.float64), (L, p)).copy(),
+        "n_iter": np.zeros(L, dtype=int),
+        "n_eval": np.zeros(L, dtype=int),
+    }
+    if not valid.any():
+        return fit
+
+    sub = {k: v[valid] for k, v in sums.items()}
+    log_theta, n_iter, n_eval = _newton_theta(
+        sub, log_theta0[valid], terms=_reml_terms_batch
+    )
+    _, A, beta, rss = _reml_terms_batch(log_theta, sub)
+    sigma2 = rss / (sub["n"].sum(axis=1) - p)
+
+    fit["beta"][valid] = beta
+    fit["varFix"][valid] = sigma2[:, None, None] * np.linalg.inv(A)
+    fit["sigma2"][valid] = sigma2
+    fit["sigma2_pat"][valid] = sigma2 * np.exp(log_theta)
+    fit["n_iter"][valid] = n_iter
+    fit["n_eval"][valid] = n_eval
+
+    return fit
+
+
+def wald_test(fit, cols):
+    """Overall F-test on a subset of fixed effects (as in anova.lme).
+
+    Returns F-values, numerator and denominator degrees of freedom and p-values.
+    """
+
+    b = fit["beta"][:, cols]
+    V = fit["varFix"][:, cols][:, :, cols]
+    q = len(cols)
+    F = np.einsum("sp,sp->s", b, np.linalg.solve(V, b[:, :, None])[:, :, 0]) / q
+    dendf = fit["df"][..., cols].min(axis=-1)
+    pval = stats.f.sf(F, q, dendf)
+
+    return F, q, dendf, pval
+
+
+def region_means(fit):
+    """Means and SE per region, as reported by the R files.
+
+    Intercept is re-added to the fixed effects, while SE are the ones of
+    the fixed effects (i.e. of the differences from the reference region).
+    """
+
+    means = fit["beta"].copy()
+    means[:, 1:] += means[:, :1]
+    sems = np.sqrt(np.diagonal(fit["varFix"], axis1=1, axis2=2))
+
+    return means, sems
+
+
+def _r_squared_marginal(fit, X):
+    """Marginal R2 of Nakagawa & Schielzeth (as MuMIn's r.squaredGLMM)"""
+
+    var_fix = np.var(fit["beta"] @ X.T, axis=1, ddof=1)
+
+    return var_fix / (var_fix + fit["sigma2_pat"] + fit["sigma2"])
+
+
+###
+# Tests
+###
+
+
+def compute_test_regs(data, var, save_path, save_name_add="", regions=Regions):
+    """Compute LME test on 'categorical' data with 'region' factor, as in LME_regs_single.R.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient, region and parameter data.
+    var : str
+        Name of the variable of interest in data.
+    save_path : str
+        Path where the csv files are saved.
+    save_name_add : str
+        Additional string to append to the csv file names.
+    regions : list
+        Levels of the 'region' factor, the first is the reference.
+
+    Returns
+    -------
+    Results : list
+        A list with two dataframes:
+          - df_coef : LME fixed effects and SE for each level.
+          - df_test : p-values for overall significance and pairwise comparisons.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    # Run model
+    X = _design_regs(data["region"], regions)
+    fit = fit_lme(X, data[var].to_numpy(dtype=np.float64), data["pat"])
+    df_coef, df_test = _regs_tables(fit, regions)[0]
+
+    # Save
+    _write_csv(df_coef, save_path + "Test_coef_" + var + save_name_add + ".csv")
+    _write_csv(df_test, save_path + "Test_pval_" + var + save_name_add + ".csv")
+
+    return [df_coef, df_test]
+
+
+def _regs_tables(fit, regions):
+    """Coefficients and test dataframes (as in LME_regs_single.R) of every fitted column"""
+
+    # Average values per category
+    means, sems = region_means(fit)
+
+    # Overall p-value and pairwise contrasts
+    F, numdf, dendf, pval = wald_test(fit, np.arange(1, len(regions)))
+    contrasts = pairwise_contrasts(fit, regions)
+    names = contrasts["names"]
+    n_pairs = len(names)
+
+    tables = []
+    for s in range(len(F)):
+        df_coef = pd.DataFrame(
+            {"Regions": regions, "Coef": means[s], "SE": sems[s]},
+            index=_r_index(len(regions)),
+        )
+        df_test = pd.DataFrame(
+            {
+                "Comparisons": ["Overall"] + names,
+                "statistics": np.r_[F[s], contrasts["t_ratio"][s]],
+                "numdf": np.r_[numdf, np.full(n_pairs, contrasts["df"][s])].astype(
+                    np.float64
+                ),
+                "dendf": np.r_[dendf, np.zeros(n_pairs)],
+                "pvalue": np.r_[pval[s], contrasts["pval"][s]],
+            },
+            index=_r_index(n_pairs + 1),
+        )
+        tables.append([df_coef, df_test])
+
+    return tables
+
+
+def _fit_corr(data):
+    """Fit 'y ~ x' LME and return m, q, rho, F, numdf, dendf and p-value"""
+
+    X = np.column_stack([np.ones(len(data)), data["x"].to_numpy(dtype=np.float64)])
+    fit = fit_lme(X, data["y"].to_numpy(dtype=np.float64), data["pat"])
+    F, numdf, dendf, pval = wald_test(fit, [1])
+    m = fit["beta"][0, 1]
+    rho = np.sqrt(_r_squared_marginal(fit, X)[0]) * np.sign(m)
+
+    return [m, fit["beta"][0, 0], rho, F[0], numdf, dendf, pval[0]]
+
+
+def _corr_table(Group, res):
+    """Dataframe of correlation tests (as in LME_corr.R), one row per group"""
+
+    df_test = pd.DataFrame(
+        res,
+        index=_r_index(len(Group)),
+        columns=["m", "q", "rho", "statistics", "numdf", "dendf", "pval"],
+    )
+    df_test.insert(0, "Group", Group)
+    df_test[["numdf", "dendf"]] = df_test[["numdf", "dendf"]].astype(np.float64)
+
+    return df_test
+
+
+def compute_test_corr(
+    data, var_x, var_y, save_path, save_name_add="", run_single=True, regions=Regions
+):
+    """Compute LME regression with random intercepts, as in LME_corr.R.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient (pat), region and parameters data (x and y).
+    var_x : str
+        Name of the independent variable (for file name).
+    var_y : str
+        Name of the dependent variable (for file name).
+    save_path : str
+        Path where the csv files are saved.
+    save_name_add : str
+        Additional string to append to the csv file names.
+    run_single : bool
+        If True (Default), run regression for every region.
+    regions : list
+        Regions for the single regressions.
+
+    Returns
+    -------
+    df_test : pandas DataFrame
+        Dataframe with regression coefficients and p-values.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    # LME - Random intercepts on all regions
+    Group = ["Overall"]
+    res = [_fit_corr(data)]
+
+    # LME - Random intercepts on single regions
+    if run_single:
+        Group += regions
+        for reg in regions:
+            res_reg = _fit_corr(data[data["region"] == reg])
+            res_reg[-1] = min(res_reg[-1] * len(regions), 1)  # Bonferroni correction
+            res.append(res_reg)
+
+    df_test = _corr_table(Group, res)
+    _write_csv(
+        df_test,
+        save_path + "Test_corr_" + var_x + "_" + var_y + save_name_add + ".csv",
+    )
+
+    return df_test
+
+
+def _fit_corr_batch(x, y, group, L, M):
+    """Fit a batch of 'y ~ x' LMEs from observations (x, y) of group 'group'
+    (model * M + patient) and return m, q, rho, F, numdf, dendf and p-value
+    of every model, (L, 7)"""
+
+    sums = _batch_sums_corr(x, y, group, L, M)
+
+    # Denominator degrees of freedom (as nlme), x being inner if it varies
+    # within any patient of the model
+    n, sx = sums["n"], sums["sX"][:, :, 1]
+    N, M_l = n.sum(axis=1), (n > 0).sum(axis=1)
+    sxx = np.bincount(group, x ** 2, L * M).reshape(L, M)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        within = np.where(n > 0, sxx - sx ** 2 / n, 0)
+    inner = np.any(within > 1e-10 * np.maximum(sxx, 1), axis=1)
+    df = np.column_stack([M_l - 2 + inner, np.where(inner, N - M_l - 1, M_l - 2)])
+
+    fit = fit_lme_batch(sums, df)
+    F, numdf, dendf, pval = wald_test(fit, [1])
+
+    # Marginal R2, with variance of fitted values from the sums
+    Sx, Sxx = sums["XtX"][:, 0, 1], sums["XtX"][:, 1, 1]
+    m = fit["beta"][:, 1]
+    var_fix = m ** 2 * (Sxx - Sx ** 2 / N) / (N - 1)
+    r2 = var_fix / (var_fix + fit["sigma2_pat"] + fit["sigma2"])
+
+    rho = np.sqrt(r2) * np.sign(m)
+
+    return np.column_stack(
+        [m, fit["beta"][:, 0], rho, F, np.full(L, numdf), dendf, pval]
+    )
+
+
+def _fit_corr_multiple(X_steps, y, groups):
+    """Fit 'y ~ x' LMEs with x at every step (columns of X_steps) at once, and return
+    m, q, rho, F, numdf, dendf and p-value of every step, (S, 7)"""
+
+    _, idx = np.unique(np.asarray(groups), return_inverse=True)
+    M = idx.max() + 1
+    S = X_steps.shape[1]
+
+    # One batch of models, with observations grouped by (step, patient)
+    group = (idx[None, :] + M * np.arange(S)[:, None]).ravel()
+
+    return _fit_corr_batch(X_steps.T.ravel(), np.tile(y, S), group, S, M)
+
+
+def compute_test_corr_multiple(
+    data,
+    steps,
+    var_y,
+    save_path,
+    save_name_add="",
+    run_single=True,
+    correction="bonferroni",
+    alpha=0.05,
+    regions=Regions,
+):
+    """Compute LME regressions with random intercepts (as in LME_corr.R) of a
+    variable on 'sequential' data (e.g. ACF values), at every step.
+
+    The regressions of all the steps are fitted at once, from per-patient sums.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient (pat), region, var_y and one column per step.
+    steps : list
+        Columns of the steps in data.
+    var_y : str
+        Name of the dependent variable (e.g. onset or peak).
+    save_path : str
+        Path where the csv file is saved.
+    save_name_add : str
+        Additional string to append to the csv file name.
+    run_single : bool
+        If True (Default), run regressions for every region (with Bonferroni
+        correction over regions, as in LME_corr.R).
+    correction : str
+        Correction of p-values over steps (see helpers.adjust_pvals), within
+        every group. Default to "bonferroni".
+    alpha : float
+        Level of significance of the blocks of steps.
+    regions : list
+        Regions for the single regressions.
+
+    Returns
+    -------
+    Results : list
+        - df_test : regression coefficients (m, q), rho and p-values for every
+          Group ("Overall" and single regions) and step.
+        - sign_blocks : dict with [start, end] of blocks of significant steps of
+          every Group (see helpers.compute_sig_blocks).
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    Group = ["Overall"] + (list(regions) if run_single else [])
+    df_test, sign_blocks = [], {}
+    for group in Group:
+        data_g = data if group == "Overall" else data[data["region"] == group]
+        data_g = data_g.dropna(subset=[var_y])
+        res = _fit_corr_multiple(
+            data_g[steps].to_numpy(dtype=np.float64),
+            data_g[var_y].to_numpy(dtype=np.float64),
+            data_g["pat"],
+        )
+        if group != "Overall":
+            res[:, -1] = np.minimum(res[:, -1] * len(regions), 1)  # Bonferroni
+
+        # Correction over steps (of fitted steps, e.g. not lag 0 of ACFs)
+        pval = res[:, -1]
+        fitted = ~np.isnan(pval)
+        pval[fitted] = adjust_pvals(pval[fitted], correction)
+
+        df_g = _corr_table([group] * len(steps), res)
+        df_g.insert(1, "steps", np.asarray(steps, dtype=np.float64))
+        df_test.append(df_g)
+        sign_blocks[group] = compute_sig_blocks(np.nan_to_num(pval, nan=1), alpha)
+
+    df_test = pd.concat(df_test)
+    df_test.index = _r_index(len(df_test))
+    _write_csv(
+        df_test, save_path + "Test_corr_multiple_" + var_y + save_name_add + ".csv"
+    )
+
+    return [df_test, sign_blocks]
+
+
+def corr_multiple_tables(df_test, stat="m", regions=Regions):
+    """Wide tables (steps x regions) of a statistic of compute_test_corr_multiple
+    and of its standard error, as df_mean and df_sem of plot_seq_regs.plot.
+
+    The standard error is that of the slope (|m| / sqrt(F)) for stat="m",
+    and zero for other statistics.
+    """
+
+    df_test = df_test[df_test["Group"].isin(regions)]
+    df_mean = df_test.pivot(index="steps", columns="Group", values=stat)
+    if stat == "m":
+        se = df_test["m"].abs() / np.sqrt(df_test["statistics"])
+        df_sem = df_test.assign(se=se).pivot(
+            index="steps", columns="Group", values="se"
+        )
+    else:
+        df_sem = df_mean * 0
+
+    regions = [r for r in regions if r in df_mean.columns]
+    df_mean = df_mean[regions].reset_index(drop=True)
+    df_sem = df_sem[regions].reset_index(drop=True)
+
+    return df_mean, df_sem
+
+
+def corr_matrix(df_batch, variables, stat="rho"):
+    """Matrix of a statistic of correlation tests (rows var_x, columns var_y) for
+    every Group (first level of the index), e.g. as input of a heat-map.
+    Pairs tested in one order only fill both (var_x, var_y) and (var_y, var_x),
+    so that the matrix is symmetric (for m and q, the regression is the tested
+    one, of var_y on var_x). Pairs that were not tested are NaN."""
+
+    df_matrix = df_batch.pivot_table(
+        index=["Group", "var_x"], columns="var_y", values=stat, dropna=False
+    )
+    Group = df_batch["Group"].unique()
+    df_matrix = df_matrix.reindex(
+        index=pd.MultiIndex.from_product([Group, variables], names=["Group", "var_x"]),
+        columns=pd.Index(variables, name="var_y"),
+    )
+
+    # Mirror pairs tested in one order
+    V = len(variables)
+    mat = df_matrix.to_numpy().reshape(len(Group), V, V)
+    mat = np.where(np.isnan(mat), mat.transpose(0, 2, 1), mat)
+    df_matrix.loc[:, :] = mat.reshape(-1, V)
+
+    return df_matrix
+
+
+def compute_test_corr_matrix(
+    data,
+    variables,
+    save_path,
+    save_name_add="",
+    run_single=True,
+    correction="bonferroni",
+    stat="rho",
+    regions=Regions,
+):
+    """Compute LME regressions with random intercepts (as in LME_corr.R) between
+    all pairs of variables, for all regions in one batch.
+
+    Every pair (var_x, var_y) with var_x before var_y in variables is tested, using
+    the channels where both are available. Patients are indexed once for the whole
+    table, and the models of all pairs and groups are fitted together from
+    per-patient sums.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient (pat), region and all the variables (e.g. as
+        returned by helpers.get_resp_params).
+    variables : list of str
+        Variables to correlate (e.g. tau, exp, off, onset, peak).
+    save_path : str
+        Path where the csv files are saved.
+    save_name_add : str
+        Additional string to append to the csv file names.
+    run_single : bool
+        If True (Default), run regressions for every region (with Bonferroni
+        correction over regions, as in LME_corr.R).
+    correction : str
+        Correction of p-values across pairs, within every group (see
+        helpers.adjust_pvals). Default to "bonferroni".
+    stat : str
+        Statistic of the matrix (column of df_batch). Default to "rho".
+    regions : list
+        Regions for the single regressions.
+
+    Returns
+    -------
+    Results : list
+        - df_batch : long table of regression coefficients (m, q), rho and
+          p-values of every pair (var_x, var_y) and Group, as run_test_corr_batch.
+        - df_matrix : stat of every Group (index level) and pair (var_x as rows,
+          var_y as columns), symmetric: the lower triangle repeats the tests of
+          the upper one (NaN on the diagonal).
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    # Shared index of patients and values of all variables
+    _, pat_idx = np.unique(np.asarray(data["pat"]), return_inverse=True)
+    M = pat_idx.max() + 1
+    region = np.asarray(data["region"])
+    values = data[list(variables)].to_numpy(dtype=np.float64)
+    valid = ~np.isnan(values)
+
+    Group = ["Overall"] + (list(regions) if run_single else [])
+    in_group = [np.ones(len(data), dtype=bool)] + [region == reg for reg in Group[1:]]
+    pairs = [
+        (i, j) for i in range(len(variables)) for j in range(i + 1, len(variables))
+    ]
+
+    # One batch of models, with observations grouped by (pair, group, patient)
+    rows, models = [], []
+    for i, j in pairs:
+        for mask in in_group:
+            rows.append(np.flatnonzero(mask & valid[:, i] & valid[:, j]))
+            models.append((i, j))
+    l_rows = np.repeat(np.arange(len(rows)), [len(r) for r in rows])
+    rows = np.concatenate(rows)
+    i_x, i_y = np.array(models)[l_rows].T
+    res = _fit_corr_batch(
+        values[rows, i_x],
+        values[rows, i_y],
+        l_rows * M + pat_idx[rows],
+        len(models),
+        M,
+    )
+    res = res.reshape(len(pairs), len(Group), -1)
+    if run_single:
+        res[:, 1:, -1] = np.minimum(res[:, 1:, -1] * len(regions), 1)  # Bonferroni
+
+    pairs = [(variables[i], variables[j]) for i, j in pairs]
+    df_tests = [_corr_table(Group, res_pair) for res_pair in res]
+    df_batch = stack_corr_tests(df_tests, pairs, correction=correction)
+    df_matrix = corr_matrix(df_batch, variables, stat)
+
+    # Save
+    _write_csv(df_batch, save_path + "Test_corr_matrix" + save_name_add + ".csv")
+    _write_csv(
+        df_matrix.reset_index(),
+        save_path + "Test_corr_matrix_" + stat + save_name_add + ".csv",
+    )
+
+    return [df_batch, df_matrix]
+
+
+def compute_test_regs_multiple(
+    data,
+    save_path,
+    save_name_add="",
+    regions=Regions,
+    optimizer="grid",
+    pairwise=False,
+):
+    """Compute LME test on 'sequential' data, as in LME_regs_multiple.R.
+
+    The random-intercept models of all the steps are fitted at once,
+    as they share the same design matrix and grouping.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient, channel, resp, region and one column per step.
+    save_path : str
+        Path where the csv files are saved.
+    save_name_add : str
+        Additional string to append to the csv file names.
+    regions : list
+        Levels of the 'region' factor, the first is the reference.
+    optimizer : str
+        Optimizer of the variance components (see fit_lme). If "newton" or "warm",
+        the number of iterations and criterion evaluations of each step are
+        added to df_test.
+    pairwise : bool
+        If True, also compute p-values of pairwise comparisons between regions
+        at each step (Tukey-adjusted, with Bonferroni correction).
+
+    Returns
+    -------
+    Results : list
+        A list with two dataframes:
+          - df_coef : LME fixed effects and SE for each step.
+          - df_test : p-values for overall significance (with Bonferroni correction).
+        If pairwise is True, a third dataframe:
+          - df_pairs : p-values of pairwise comparisons for each step
+            (see helpers.compute_pairs_sig_blocks).
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    # Steps are all columns after pat, chan, resp and region
+    steps = data.columns[4:].astype(np.float64)
+    N = len(steps)
+
+    X = _design_regs(data["region"], regions)
+    Y = data.iloc[:, 4:].to_numpy(dtype=np.float64)
+    fit = fit_lme(X, Y, data["pat"], optimizer=optimizer)
+
+    # Significance test
+    _, _, _, pval = wald_test(fit, np.arange(1, len(regions)))
+    pval = pval * N  # Bonferroni correction
+
+    # Fixed effects, re-adding intercept term, and Standard Errors
+    means, sems = region_means(fit)
+
+    df_coef = pd.DataFrame(
+        np.hstack([means, sems]),
+        index=_r_index(N),
+        columns=[r + "_mean" for r in regions] + [r + "_sem" for r in regions],
+    )
+    df_test = pd.DataFrame({"steps": steps, "pval": pval}, index=_r_index(N))
+    if optimizer != "grid":
+        df_test["n_iter"] = fit["n_iter"]
+        df_test["n_eval"] = fit["n_eval"]
+
+    # Save
+    _write_csv(df_coef, save_path + "Test_coef" + save_name_add + ".csv")
+    _write_csv(df_test, save_path + "Test_pval" + save_name_add + ".csv")
+
+    if not pairwise:
+        return [df_coef, df_test]
+
+    # Pairwise comparisons of all steps at once
+    contrasts = pairwise_contrasts(fit, regions)
+    df_pairs = pd.DataFrame(
+        contrasts["pval"] * N, index=_r_index(N), columns=contrasts["names"]
+    )
+    df_pairs.insert(0, "steps", steps)
+    _write_csv(df_pairs, save_path + "Test_pairs" + save_name_add + ".csv")
+
+    return [df_coef, df_test, df_pairs]
+
+
+def run_test_regs_multiple(
+    df_data,
+    save_path,
+    save_name_add="",
+    regions=Regions,
+    optimizer="grid",
+    pairwise=False,
+):
+    """Run test over categories (regions) for multiple 'steps'
+    in Python and return pandas objects."""
+
+    # First, make the index a column
+    df_data_py = df_data.reset_index()
+
+    return compute_test_regs_multiple(
+        df_data_py, save_path, save_name_add, regions, optimizer, pairwise
+    )
+
+
+def run_test_regs(df_data, var, save_path, save_name_add="", regions=Regions):
+    """Run test over categories (regions) in Python and return pandas objects."""
+
+    # First, make the index a column
+    df_data_py = df_data.reset_index()
+
+    return compute_test_regs(df_data_py, var, save_path, save_name_add, regions)
+
+
+def run_test_regs_batch(
+    df_data, variables, save_path, save_name_add="", subsets=None, regions=Regions
+):
+    """Run tests over categories (regions) for several variables and subsets of rows
+    in Python and return pandas objects, as run_R_test_regs_batch.
+
+    All variables of a subset are fitted at once."""
+
+    # First, make the index a column
+    df_data_py = df_data.reset_index()
+    if subsets is None:
+        subsets = {"all": None}
+
+    results, keys = [], []
+    for subset, query in subsets.items():
+        if query is None:
+            data, save_name = df_data_py, save_name_add
+        else:
+            data = df_data_py[df_data_py.eval(query)]
+            save_name = "_".join(s for s in [subset, save_name_add] if s)
+        save_name = _format_save_name(save_name)
+
+        X = _design_regs(data["region"], regions)
+        fit = fit_lme(X, data[list(variables)].to_numpy(dtype=np.float64), data["pat"])
+        for var, (df_coef, df_test) in zip(variables, _regs_tables(fit, regions)):
+            _write_csv(df_coef, save_path + "Test_coef_" + var + save_name + ".csv")
+            _write_csv(df_test, save_path + "Test_pval_" + var + save_name + ".csv")
+            results.append([df_coef, df_test])
+            keys.append((var, subset))
+
+    return stack_regs_tests(results, keys)
+
+
+def run_test_corr(
+    df_data, var_x, var_y, save_path, save_name_add="", run_single=True, regions=Regions
+):
+    """Run test of correlations in Python and return pandas objects."""
+
+    # First, make the index a 'pat' column
+    df_data_py = df_data.rename_axis("pat").reset_index()
+
+    # Then, keep only pat, region, var_x and var_y varibles and re-name
+    df_data_py = df_data_py.loc[:, ["pat", "region", var_x, var_y]]
+    df_data_py.columns = ["pat", "region", "x", "y"]
+
+    return compute_test_corr(
+        df_data_py, var_x, var_y, save_path, save_name_add, run_single, regions
+    )
+
+
+def run_test_corr_batch(
+    df_data,
+    pairs,
+    save_path,
+    save_name_add="",
+    run_single=True,
+    families=None,
+    correction="bonferroni",
+    regions=Regions,
+):
+    """Run tests of correlations for several (var_x, var_y) pairs in Python
+    and return a single (long) pandas dataframe, as run_R_test_corr_batch."""
+
+    df_tests = [
+        run_test_corr(
+            df_data, var_x, var_y, save_path, save_name_add, run_single, regions
+        )
+        for var_x, var_y in pairs
+    ]
+    df_batch = stack_corr_tests(df_tests, pairs, families, correction)
+
+    # Save
+    save_name_add = _format_save_name(save_name_add)
+    _write_csv(df_batch, save_path + "Test_corr_batch" + save_name_add + ".csv")
+
+    return df_batch
+
+
+def run_test_corr_multiple(
+    df_data,
+    df_resp,
+    save_path,
+    save_name_add="",
+    latencies=("onset", "peak"),
+    **kwargs
+):
+    """Run regressions of response latencies on 'sequential' data (e.g. ACF values)
+    at every step in Python and return pandas objects.
+
+    df_data is a wide table of channels (patients as index, chan, resp and region,
+    then one column per step), joined to df_resp with helpers.get_resp_params.
+    Returns the results of compute_test_corr_multiple for every latency (dict).
+    """
+
+    # Join channels with responses, steps are all columns after chan, resp, region
+    steps = list(df_data.columns[3:])
+    df_data_py = get_resp_params(df_resp, df_data, steps)
+    df_data_py = df_data_py.rename_axis("pat").reset_index()
+
+    return {
+        lat: compute_test_corr_multiple(
+            df_data_py, steps, lat, save_path, save_name_add, **kwargs
+        )
+        for lat in latencies
+    }
+
+
+def run_test_corr_matrix(df_data, variables, save_path, save_name_add="", **kwargs):
+    """Run tests of correlations between all pairs of variables in Python and
+    return pandas objects (see compute_test_corr_matrix)."""
+
+    # First, make the index a 'pat' column
+    df_data_py = df_data.rename_axis("pat").reset_index()
+
+    return compute_test_corr_matrix(
+        df_data_py, variables, save_path, save_name_add, **kwargs
+    )
@@ -0,0 +1,220 @@
+"""
+Spatial autocorrelation (Moran's I) of electrode parameters in MNI space.
+
+Electrodes are connected in a sparse graph of k nearest neighbours or of
+neighbours closer than a distance threshold, with (row-standardized) binary
+weights W. For a standardized parameter z:
+  - global Moran's I = N / S0 * z'Wz / z'z (S0 sum of the weights),
+  - local Moran's I_i = z_i * (Wz)_i / m2, with m2 = z'z / N.
+
+P-values are computed against permutations of the parameter over electrodes: the
+permuted maps of a chunk are the columns of a dense matrix, so that W is applied
+to all of them with a single sparse matrix product. Local p-values use total
+(not conditional) permutations, which differ negligibly when the number of
+neighbours is small compared to the number of electrodes.
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from utils.lme import _r_index, _write_csv, _format_save_name
+
+# Number of permutations evaluated together
+chunk_size = 200
+
+
+def spatial_weights(coords, k=8, distance=None, row_standardize=True):
+    """Sparse (N, N) weights between electrodes.
+
+    Parameters
+    ----------
+    coords : ndarray
+        (N, 3) MNI coordinates of the electrodes.
+    k : int
+        Number of nearest neighbours of every electrode. Default to 8.
+    distance : float
+        If given, neighbours are the electrodes closer than distance (in mm)
+        instead of the k nearest ones.
+    row_standardize : bool
+        If True (Default), weights of every electrode sum to 1 (electrodes
+        without neighbours have no weights).
+
+    Returns
+    -------
+    W : scipy.sparse.csr_matrix
+        Weights, with zeros on the diagonal.
+    """
+
+    N = len(coords)
+    tree = cKDTree(coords)
+    if distance is None:
+        _, idx = tree.query(coords, k=k + 1)
+        rows = np.repeat(np.arange(N), k)
+        cols = idx[:, 1:].ravel()
+    else:
+        pairs = tree.query_pairs(distance, output_type="ndarray")
+        rows = np.r_[pairs[:, 0], pairs[:, 1]]
+        cols = np.r_[pairs[:, 1], pairs[:, 0]]
+
+    W = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(N, N))
+    if row_standardize:
+        deg = np.asarray(W.sum(axis=1)).ravel()
+        W = sparse.diags(1 / np.where(deg > 0, deg, 1)) @ W
+
+    return W.tocsr()
+
+
+def _moran(W, Z):
+    """Global (S,) and local (N, S) Moran's I of the columns of Z (standardized)"""
+
+    N = Z.shape[0]
+    WZ = W @ Z
+    m2 = np.sum(Z ** 2, axis=0) / N
+    I_local = Z * WZ / m2
+    I_global = I_local.sum(axis=0) / W.sum()
+
+    return I_global, I_local
+
+
+def _perm_chunk(W, z, I_local, n_perm, seed):
+    """Global Moran's I of a chunk of permutations, and number of permutations
+    with local Moran's I above and below the observed one, for every electrode"""
+
+    rng = np.random.default_rng(seed)
+    Zp = rng.permuted(np.tile(z[:, None], (1, n_perm)), axis=0)
+    WZ = W @ Zp
+    I_local_perm = z[:, None] * WZ / np.mean(z ** 2)
+    I_global_perm = np.sum(Zp * WZ, axis=0) / np.mean(z ** 2) / W.sum()
+
+    n_ge = np.sum(I_local_perm >= I_local[:, None], axis=1)
+    n_le = np.sum(I_local_perm <= I_local[:, None], axis=1)
+
+    return I_global_perm, n_ge, n_le
+
+
+def _moran_var(y, W, n_perm, n_jobs, seed):
+    """Global and local Moran's I of a parameter, with permutation p-values"""
+
+    z = (y - y.mean()) / y.std()
+    I_global, I_local = _moran(W, z[:, None])
+    I_global, I_local = I_global[0], I_local[:, 0]
+
+    n_chunks = int(np.ceil(n_perm / chunk_size))
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    sizes = [min(chunk_size, n_perm - i * chunk_size) for i in range(n_chunks)]
+    args = [(W, z, I_local, n, s) for n, s in zip(sizes, seeds)]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            res = list(executor.map(_perm_chunk, *zip(*args)))
+    else:
+        res = [_perm_chunk(*a) for a in args]
+
+    I_null = np.concatenate([r[0] for r in res])
+    n_ge = np.sum([r[1] for r in res], axis=0)
+    n_le = np.sum([r[2] for r in res], axis=0)
+
+    df_global = {
+        "I": I_global,
+        "expected": -1 / (len(z) - 1),
+        "z_score": (I_global - I_null.mean()) / I_null.std(ddof=1),
+        "pval": (1 + np.sum(I_null >= I_global)) / (n_perm + 1),
+    }
+
+    # Quadrants of the Moran scatterplot (H: above mean, L: below mean)
+    lag = W @ z
+    quad = np.where(z > 0, "H", "L").astype(object) + np.where(lag > 0, "H", "L")
+    df_local = {
+        "I": I_local,
+        "pval": np.minimum(2 * (1 + np.minimum(n_ge, n_le)) / (n_perm + 1), 1),
+        "quadrant": quad,
+    }
+
+    return df_global, df_local
+
+
+def compute_moran(
+    data,
+    variables,
+    save_path,
+    save_name_add="",
+    k=8,
+    distance=None,
+    n_perm=9999,
+    n_jobs=1,
+    seed=0,
+):
+    """Global and local Moran's I of electrode parameters in MNI space.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient (pat), channel (chan), region, MNI coordinates
+        (mni_x, mni_y, mni_z) and parameters (as returned by helpers.get_MNI_params).
+    variables : list of str
+        Parameters to test (e.g. tau, exp, onset, peak).
+    save_path : str
+        Path where the csv files are saved.
+    save_name_add : str
+        Additional string to append to the csv file names.
+    k : int
+        Number of nearest neighbours of every electrode. Default to 8.
+    distance : float
+        If given, neighbours are the electrodes closer than distance (in mm).
+    n_perm : int
+        Number of permutations. Default to 9999.
+    n_jobs : int
+        Number of processes evaluating the permutations. Default to 1.
+    seed : int
+        Seed of the random generator (results do not depend on n_jobs).
+
+    Returns
+    -------
+    Results : list
+        - df_global : Moran's I, its expected value under no autocorrelation,
+          z-score and p-value (one-sided, for spatial clustering) of each variable.
+        - df_local : local Moran's I, two-sided p-value and quadrant of the Moran
+          scatterplot (HH, LL: clusters, HL, LH: outliers) of each electrode
+          and variable.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+    if isinstance(variables, str):
+        variables = [variables]
+
+    df_global, df_local = [], []
+    for var in variables:
+        data_var = data.dropna(subset=[var])
+        coords = data_var[["mni_x", "mni_y", "mni_z"]].to_numpy(dtype=np.float64)
+        y = data_var[var].to_numpy(dtype=np.float64)
+        W = spatial_weights(coords, k, distance)
+        res_global, res_local = _moran_var(y, W, n_perm, n_jobs, seed)
+
+        df_global.append(pd.DataFrame(res_global, index=[var]))
+        df_var = data_var[["pat", "chan", "region"]].reset_index(drop=True)
+        df_var.insert(0, "variable", var)
+        df_local.append(pd.concat([df_var, pd.DataFrame(res_local)], axis=1))
+
+    df_global = pd.concat(df_global).rename_axis("variable").reset_index()
+    df_global["n_perm"] = n_perm
+    df_global.index = _r_index(len(df_global))
+    df_local = pd.concat(df_local, ignore_index=True)
+    df_local.index = _r_index(len(df_local))
+
+    # Save
+    _write_csv(df_global, save_path + "Test_moran" + save_name_add + ".csv")
+    _write_csv(df_local, save_path + "Test_moran_local" + save_name_add + ".csv")
+
+    return [df_global, df_local]
+
+
+def run_moran(df_data, variables, save_path, save_name_add="", **kwargs):
+    """Run Moran's I tests on the output of helpers.get_MNI_params
+    and return pandas objects."""
+
+    # First, make the index a 'pat' column
+    df_data_py = df_data.rename_axis("pat").reset_index()
+
+    return compute_moran(df_data_py, variables, save_path, save_name_add, **kwargs)
@@ -0,0 +1,198 @@
+"""
+Cluster-based permutation test for 'sequential' data (e.g. ACF or PSD profiles).
+
+The F-value of the region effect is computed at every step (as in LME_regs_multiple.R)
+and contiguous steps above the threshold form clusters, weighted by their mass
+(sum of F-values). Region labels are permuted within patients, and the cluster
+masses are compared with the null distribution of the maximum mass.
+
+Permuting labels within patients does not change the number of channels per region
+in each patient, so all quantities of the (GLS) fit apart from X'y are fixed.
+Keeping the variance components of the observed fit, the F-values of all
+permutations and steps are evaluated at once with matrix products.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.lme import (
+    Regions,
+    fit_lme,
+    _design_regs,
+    _group_sums,
+    _r_index,
+    _write_csv,
+    _format_save_name,
+)
+
+# Number of permutations evaluated together
+chunk_size = 250
+
+
+def _within_group_perms(group_idx, n_perm, rng):
+    """(n_perm, N) indexes permuting observations within groups"""
+
+    N = len(group_idx)
+    order = np.argsort(group_idx, kind="stable")
+    keys = group_idx[None, :] + rng.random((n_perm, N))
+    perms = np.empty((n_perm, N), dtype=np.intp)
+    perms[:, order] = np.argsort(keys, axis=1)
+
+    return perms
+
+
+def _perm_F(X_perm, Y, invariants, cols):
+    """F-values of the region effect, (P, S), for permuted designs X_perm (P, N, p)"""
+
+    Ainv, G, corr, c, dof = invariants
+    q = len(cols)
+
+    XtY = np.matmul(X_perm.transpose(0, 2, 1), Y)  # (P, p, S)
+    b = XtY.transpose(0, 2, 1) - corr[None]
+    beta = np.einsum("spq,Psq->Psp", Ainv, b)
+    sigma2 = (c[None] - np.einsum("Psp,Psp->Ps", b, beta)) / dof
+    beta_r = beta[..., cols]
+
+    return np.einsum("Psq,sqr,Psr->Ps", beta_r, G, beta_r) / (q * sigma2)
+
+
+def _max_cluster_mass(F, thr):
+    """Maximum mass of clusters of contiguous steps with F > thr, for each row"""
+
+    supra = F > thr
+    cs = np.cumsum(np.where(supra, F, 0), axis=1)
+    # Cumulative sum at the last step before each cluster
+    base = np.maximum.accumulate(np.where(supra, 0, cs), axis=1)
+
+    return np.max(cs - base, axis=1)
+
+
+def _null_chunk(X, Y, group_idx, invariants, cols, thr, n_perm, seed):
+    """Maximum cluster masses of a chunk of permutations"""
+
+    rng = np.random.default_rng(seed)
+    perms = _within_group_perms(group_idx, n_perm, rng)
+    F = _perm_F(X[perms], Y, invariants, cols)
+
+    return _max_cluster_mass(F, thr)
+
+
+def compute_test_clusters(
+    data,
+    save_path,
+    save_name_add="",
+    n_perm=1000,
+    cluster_alpha=0.05,
+    alpha=0.05,
+    n_jobs=1,
+    seed=0,
+    regions=Regions,
+):
+    """Cluster-based permutation test of the region effect on 'sequential' data.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient, channel, resp, region and one column per step.
+    save_path : str
+        Path where the csv file is saved.
+    save_name_add : str
+        Additional string to append to the csv file name.
+    n_perm : int
+        Number of permutations. Default to 1000.
+    cluster_alpha : float
+        Pointwise (uncorrected) level defining the F threshold of clusters.
+    alpha : float
+        Level of significance of clusters.
+    n_jobs : int
+        Number of processes evaluating the permutations. Default to 1.
+    seed : int
+        Seed of the random generator (results do not depend on n_jobs).
+    regions : list
+        Levels of the 'region' factor, the first is the reference.
+
+    Returns
+    -------
+    Results : list
+        - df_clusters : start and end index, start and end step,
+          mass and p-value of every cluster.
+        - sign_blocks : [start, end] of significant clusters,
+          to be given to plot_seq_regs.plot.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    steps = data.columns[4:].astype(np.float64)
+    X = _design_regs(data["region"], regions)
+    Y = data.iloc[:, 4:].to_numpy(dtype=np.float64)
+    _, group_idx = np.unique(np.asarray(data["pat"]), return_inverse=True)
+    cols = np.arange(1, len(regions))
+
+    # Observed fit, whose variance components are kept for the permutations
+    fit = fit_lme(X, Y, group_idx)
+    theta = fit["sigma2_pat"] / fit["sigma2"]
+    sums = _group_sums(X, Y, group_idx)
+    w = theta[:, None] / (1 + theta[:, None] * sums["n"][None, :])
+    A = sums["XtX"][None] - np.einsum("sm,mp,mq->spq", w, sums["sX"], sums["sX"])
+    Ainv = np.linalg.inv(A)
+    invariants = (
+        Ainv,
+        np.linalg.inv(Ainv[:, cols][:, :, cols]),
+        np.einsum("sm,mp,ms->sp", w, sums["sX"], sums["sY"]),
+        sums["yty"] - np.einsum("sm,ms->s", w, sums["sY"] ** 2),
+        X.shape[0] - X.shape[1],
+    )
+
+    # Threshold and observed clusters
+    thr = stats.f.isf(cluster_alpha, len(cols), fit["df"][cols].min())
+    F_obs = _perm_F(X[None], Y, invariants, cols)[0]
+    supra = np.r_[False, F_obs > thr, False].astype(int)
+    starts = np.where(np.diff(supra) == 1)[0]
+    ends = np.where(np.diff(supra) == -1)[0] - 1
+    masses = np.array([F_obs[s : e + 1].sum() for s, e in zip(starts, ends)])
+
+    # Null distribution of maximum cluster mass, in chunks of permutations
+    n_chunks = int(np.ceil(n_perm / chunk_size))
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    sizes = [min(chunk_size, n_perm - i * chunk_size) for i in range(n_chunks)]
+    args = [
+        (X, Y, group_idx, invariants, cols, thr, n, s) for n, s in zip(sizes, seeds)
+    ]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            null = list(executor.map(_null_chunk, *zip(*args)))
+    else:
+        null = [_null_chunk(*a) for a in args]
+    null = np.concatenate(null)
+
+    pval = np.array([(1 + np.sum(null >= m)) / (n_perm + 1) for m in masses])
+    df_clusters = pd.DataFrame(
+        {
+            "start": starts,
+            "end": ends,
+            "steps_start": steps[starts],
+            "steps_end": steps[ends],
+            "mass": masses,
+            "pval": pval,
+        },
+        index=_r_index(len(starts)),
+    )
+    _write_csv(df_clusters, save_path + "Test_clusters" + save_name_add + ".csv")
+
+    sign_blocks = [
+        [int(s), int(e)] for s, e, p in zip(starts, ends, pval) if p < alpha
+    ]
+
+    return [df_clusters, sign_blocks]
+
+
+def run_test_clusters(df_data, save_path, save_name_add="", **kwargs):
+    """Run cluster-based permutation test over categories (regions)
+    and return pandas objects."""
+
+    # First, make the index a column
+    df_data_py = df_data.reset_index()
+
+    return compute_test_clusters(df_data_py, save_path, save_name_add, **kwargs)
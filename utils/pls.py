@@ -0,0 +1,289 @@
+"""
+Cross-validated PLS regression of an electrode parameter on MNI coordinates.
+
+The number of components is chosen by cross-validation with folds grouped by
+patient (no patient is in both the training and the test electrodes), and the
+cross-validated predictive R2 (Q2) is tested against permutations of the
+parameter over electrodes. The stability of the gradient axis (first component)
+is assessed by a hierarchical bootstrap (patients, then channels within patients)
+of its weights and loadings.
+
+With a single response, the PLS coefficients with k components (as sklearn's
+PLSRegression, with scaling) are the least-squares solution restricted to the
+Krylov space of X'y, (X'X) X'y, ... so that all permuted responses of a chunk are
+fitted at once with matrix products. Chunks of permutations and resamples are
+evaluated in parallel processes.
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.model_selection import GroupKFold
+
+from utils.bootstrap import resample_idx, sorted_groups
+from utils.lme import _r_index, _write_csv, _format_save_name
+
+# Number of permutations (or resamples) evaluated together
+chunk_size = 200
+
+Coords = ["mni_x", "mni_y", "mni_z"]
+
+
+def _pls1_coefs(Xs, Ys, n_components):
+    """Coefficients of PLS regressions of the columns of Ys on Xs (both
+    standardized) with 1 to n_components components, (n_components, S, p)."""
+
+    C = Xs.T @ Xs
+    r = (Xs.T @ Ys).T  # (S, p)
+
+    # Krylov basis, columns normalized for conditioning
+    K = [r / np.linalg.norm(r, axis=1, keepdims=True)]
+    for _ in range(1, n_components):
+        k = K[-1] @ C
+        K.append(k / np.linalg.norm(k, axis=1, keepdims=True))
+
+    coefs = []
+    for k in range(1, n_components + 1):
+        B = np.stack(K[:k], axis=2)  # (S, p, k)
+        G = np.einsum("spk,pq,sql->skl", B, C, B)
+        a = np.linalg.solve(G, np.einsum("spk,sp->sk", B, r)[:, :, None])
+        coefs.append(np.einsum("spk,sk->sp", B, a[:, :, 0]))
+
+    return np.stack(coefs)
+
+
+def _standardize(X, ref):
+    """Standardize X by the mean and std (ddof=1) of ref"""
+
+    return (X - ref.mean(axis=0)) / ref.std(axis=0, ddof=1)
+
+
+def _cv_chunk(X, Y, folds, n_components):
+    """Q2 (n_components, S) and out-of-fold predictions (n_components, N, S)
+    and first-component scores (N, S) of the columns of Y"""
+
+    pred = np.zeros((n_components,) + Y.shape)
+    scores = np.zeros(Y.shape)
+    for train, test in folds:
+        Xs = _standardize(X[train], X[train])
+        Ys = _standardize(Y[train], Y[train])
+        coefs = _pls1_coefs(Xs, Ys, n_components)
+        Xt = _standardize(X[test], X[train])
+        y_sd = Y[train].std(axis=0, ddof=1)
+        pred[:, test] = Y[train].mean(axis=0) + y_sd * np.einsum(
+            "np,ksp->kns", Xt, coefs
+        )
+        w = Xs.T @ Ys
+        scores[test] = Xt @ (w / np.linalg.norm(w, axis=0))
+
+    press = np.sum((Y[None] - pred) ** 2, axis=1)
+    tss = np.sum((Y - Y.mean(axis=0)) ** 2, axis=0)
+
+    return 1 - press / tss, pred, scores
+
+
+def _perm_chunk(X, y, folds, n_components, n_perm, seed):
+    """Q2 of a chunk of permutations of y, (n_perm, n_components)"""
+
+    rng = np.random.default_rng(seed)
+    Y = rng.permuted(np.tile(y[:, None], (1, n_perm)), axis=0)
+
+    return _cv_chunk(X, Y, folds, n_components)[0].T
+
+
+def _axis(X, y):
+    """Weights and loadings of the first PLS component (standardized data)"""
+
+    R = np.corrcoef(X, rowvar=False)
+    w = _standardize(X, X).T @ (y - y.mean())
+    w /= np.linalg.norm(w)
+
+    return w, R @ w / (w @ R @ w)
+
+
+def _boot_chunk(X, y, starts, counts, w_ref, n_boot, seed):
+    """Weights and loadings of the first PLS component of a chunk of
+    hierarchical resamples, (n_boot, 2, p)"""
+
+    rng = np.random.default_rng(seed)
+    rows, group = resample_idx(starts, counts, n_boot, rng)
+    b = group // len(starts)
+    p = X.shape[1]
+    X, y = X[rows], y[rows]
+
+    # Covariances of every resample from sums
+    n = np.bincount(b, minlength=n_boot)
+    mx = np.stack([np.bincount(b, X[:, j], n_boot) for j in range(p)], 1) / n[:, None]
+    my = np.bincount(b, y, n_boot) / n
+    Sxx = np.stack(
+        [
+            np.stack([np.bincount(b, X[:, i] * X[:, j], n_boot) for j in range(p)], 1)
+            for i in range(p)
+        ],
+        1,
+    )
+    Sxy = np.stack([np.bincount(b, X[:, j] * y, n_boot) for j in range(p)], 1)
+    cov_xx = Sxx / n[:, None, None] - mx[:, :, None] * mx[:, None, :]
+    cov_xy = Sxy / n[:, None] - mx * my[:, None]
+
+    sd = np.sqrt(np.einsum("bii->bi", cov_xx))
+    R = cov_xx / (sd[:, :, None] * sd[:, None, :])
+    w = cov_xy / sd
+    w /= np.linalg.norm(w, axis=1, keepdims=True)
+    w *= np.sign(w @ w_ref)[:, None]  # align signs with the original axis
+    Rw = np.einsum("bij,bj->bi", R, w)
+    loadings = Rw / np.einsum("bi,bi->b", w, Rw)[:, None]
+
+    return np.stack([w, loadings], axis=1)
+
+
+def _run_chunks(func, args, n, n_jobs, seed):
+    """Evaluate func(*args, n_chunk, seed) on chunks, in n_jobs processes"""
+
+    n_chunks = int(np.ceil(n / chunk_size))
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    sizes = [min(chunk_size, n - i * chunk_size) for i in range(n_chunks)]
+    chunks = [args + (m, s) for m, s in zip(sizes, seeds)]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            res = list(executor.map(func, *zip(*chunks)))
+    else:
+        res = [func(*c) for c in chunks]
+
+    return np.concatenate(res)
+
+
+def compute_pls_cv(
+    data,
+    var,
+    save_path,
+    save_name_add="",
+    max_components=3,
+    n_splits=5,
+    n_perm=1000,
+    n_boot=1000,
+    ci=0.95,
+    n_jobs=1,
+    seed=0,
+):
+    """Cross-validated PLS regression of a parameter on MNI coordinates.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient (pat), MNI coordinates (mni_x, mni_y, mni_z)
+        and the parameter (as returned by helpers.get_MNI_params).
+    var : str
+        Name of the parameter in data.
+    save_path : str
+        Path where the csv files are saved.
+    save_name_add : str
+        Additional string to append to the csv file names.
+    max_components : int
+        Maximum number of components. Default to 3 (all coordinates).
+    n_splits : int
+        Number of cross-validation folds, grouped by patient. Default to 5.
+    n_perm : int
+        Number of permutations of the parameter. Default to 1000.
+    n_boot : int
+        Number of hierarchical resamples for the axis stability. Default to 1000.
+    ci : float
+        Level of the bootstrap confidence intervals. Default to 0.95.
+    n_jobs : int
+        Number of processes evaluating permutations and resamples. Default to 1.
+    seed : int
+        Seed of the random generator (results do not depend on n_jobs).
+
+    Returns
+    -------
+    Results : list
+        - df_cv : cross-validated Q2 and correlation between predictions and data
+          (r_cv) for every number of components, with permutation p-values of Q2
+          (pval) and of the best Q2 over numbers of components (pval_max, accounting
+          for the choice), and the selected number of components (selected), i.e.
+          the one with the best Q2 if it is positive (none is selected if no
+          number of components predicts better than the mean, all Q2 <= 0).
+        - df_axis : weights and loadings of the first component (gradient axis)
+          on each coordinate, with bootstrap SE, confidence intervals and ratio of
+          loadings to their SE.
+        - scores_cv : (N,) out-of-fold scores on the first component of every
+          electrode (rows of data, NaN where var is missing), each on the axis of
+          the fold that left out its patient. Axes differ between folds, so these
+          are not positions on one common axis as the in-sample scores are.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    valid = data[var].notna().to_numpy()
+    data = data[valid]
+    X = data[Coords].to_numpy(dtype=np.float64)
+    y = data[var].to_numpy(dtype=np.float64)
+    pats = np.asarray(data["pat"])
+    n_splits = min(n_splits, len(np.unique(pats)))
+    folds = list(GroupKFold(n_splits=n_splits).split(X, y, pats))
+
+    # Cross-validation on the data
+    q2, pred, scores = _cv_chunk(X, y[:, None], folds, max_components)
+    q2, pred = q2[:, 0], pred[:, :, 0]
+    r_cv = [np.corrcoef(y, p)[0, 1] for p in pred]
+
+    # Permutations
+    args = (X, y, folds, max_components)
+    q2_null = _run_chunks(_perm_chunk, args, n_perm, n_jobs, seed)
+
+    df_cv = pd.DataFrame(
+        {
+            "n_components": np.arange(1, max_components + 1),
+            "Q2": q2,
+            "r_cv": r_cv,
+            "pval": (1 + np.sum(q2_null >= q2, axis=0)) / (n_perm + 1),
+            "pval_max": (1 + np.sum(q2_null.max(axis=1)[:, None] >= q2, axis=0))
+            / (n_perm + 1),
+        },
+        index=_r_index(max_components),
+    )
+    df_cv["selected"] = (df_cv["n_components"] == np.argmax(q2) + 1) & (q2.max() > 0)
+
+    # Axis on all data, and its stability
+    w, loadings = _axis(X, y)
+    order, _, starts, counts = sorted_groups(pats)
+    args = (X[order], y[order], starts, counts, w)
+    boot = _run_chunks(_boot_chunk, args, n_boot, n_jobs, seed)
+    q = 100 * np.array([(1 - ci) / 2, (1 + ci) / 2])
+    (w_low, load_low), (w_high, load_high) = np.percentile(boot, q, axis=0)
+    w_se, load_se = boot.std(axis=0, ddof=1)
+
+    df_axis = pd.DataFrame(
+        {
+            "coord": Coords,
+            "weight": w,
+            "weight_SE": w_se,
+            "weight_ci_low": w_low,
+            "weight_ci_high": w_high,
+            "loading": loadings,
+            "loading_SE": load_se,
+            "loading_ci_low": load_low,
+            "loading_ci_high": load_high,
+            "ratio": loadings / load_se,
+        },
+        index=_r_index(len(Coords)),
+    )
+
+    # Save
+    _write_csv(df_cv, save_path + "Test_pls_cv_" + var + save_name_add + ".csv")
+    _write_csv(df_axis, save_path + "Test_pls_axis_" + var + save_name_add + ".csv")
+
+    scores_cv = np.full(len(valid), np.nan)
+    scores_cv[valid] = scores[:, 0]
+
+    return [df_cv, df_axis, scores_cv]
+
+
+def run_pls_cv(df_data, var, save_path, save_name_add="", **kwargs):
+    """Run cross-validated PLS on the output of helpers.get_MNI_params
+    and return pandas objects."""
+
+    # First, make the index a 'pat' column
+    df_data_py = df_data.rename_axis("pat").reset_index()
+
+    return compute_pls_cv(df_data_py, var, save_path, save_name_add, **kwargs)
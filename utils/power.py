@@ -0,0 +1,338 @@
+"""
+Simulation-based power of the region and correlation LMEs.
+
+Fixed effects and variance components are estimated on an existing channel table
+(e.g. timescales, 1/f exponents or latencies), and synthetic cohorts are simulated
+from the fitted model for different numbers of patients and channels. The cohorts of
+a chunk of simulations are fitted together (see lme.fit_lme_batch) and tested
+as LME_regs_single.R (overall F-test of the region effect) and LME_corr.R
+(F-test of the slope). Chunks are evaluated in parallel processes.
+
+The regions sampled in every simulated patient (and the number of channels, if not
+given) are those of a patient of the original table drawn at random, so that
+simulated cohorts keep the regional coverage of the recordings.
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.lme import (
+    Regions,
+    fit_lme,
+    fit_lme_batch,
+    wald_test,
+    _batch_sums_regs,
+    _batch_sums_corr,
+    _design_regs,
+    _r_index,
+    _write_csv,
+    _format_save_name,
+)
+
+# Number of simulations evaluated together
+chunk_size = 250
+
+
+def estimate_regs(data, var, regions=Regions):
+    """Fixed effects, variance components and channels per (patient, region)
+    of the 'var ~ region' LME on data (with 'pat' and 'region' columns)."""
+
+    data = data.dropna(subset=[var])
+    X = _design_regs(data["region"], regions)
+    fit = fit_lme(X, data[var], data["pat"])
+
+    layouts = pd.crosstab(data["pat"], data["region"]).reindex(
+        columns=regions, fill_value=0
+    )
+
+    return {
+        "beta": fit["beta"][0],
+        "sigma2": fit["sigma2"][0],
+        "sigma2_pat": fit["sigma2_pat"][0],
+        "layouts": layouts.to_numpy(),
+        "regions": list(regions),
+    }
+
+
+def estimate_corr(data):
+    """Fixed effects and variance components of the 'y ~ x' LME on data (with
+    'pat', 'x' and 'y' columns), of the 'x ~ 1' LME (to simulate x) and channels
+    per patient."""
+
+    data = data.dropna(subset=["x", "y"])
+    x = data["x"].to_numpy(dtype=np.float64)
+    X = np.column_stack([np.ones(len(x)), x])
+    fit = fit_lme(X, data["y"], data["pat"])
+    fit_x = fit_lme(np.ones((len(x), 1)), x, data["pat"])
+
+    return {
+        "beta": fit["beta"][0],
+        "sigma2": fit["sigma2"][0],
+        "sigma2_pat": fit["sigma2_pat"][0],
+        "mu_x": fit_x["beta"][0, 0],
+        "sigma2_x": fit_x["sigma2"][0],
+        "sigma2_x_pat": fit_x["sigma2_pat"][0],
+        "layouts": data.groupby("pat").size().to_numpy(),
+    }
+
+
+def _df_regs(n_c):
+    """Denominator degrees of freedom (as nlme) of 'var ~ region' models,
+    from channels per (model, patient, region), (L, M, R)."""
+
+    M = n_c.shape[1]
+    N = n_c.sum(axis=(1, 2))
+    n_pat = n_c.sum(axis=2, keepdims=True)
+
+    # Region columns varying within patients (the intercept never does)
+    inner = ((n_c > 0) & (n_pat - n_c > 0)).any(axis=1)
+    inner[:, 0] = False
+    n_inner = inner.sum(axis=1, keepdims=True)
+
+    return np.where(inner, (N - M)[:, None] - n_inner, M - (n_c.shape[2] - n_inner))
+
+
+def _sim_chunk_regs(params, beta, n_pats, n_chans, alpha, n_sim, seed):
+    """Rejections of the region effect in a chunk of simulated cohorts"""
+
+    rng = np.random.default_rng(seed)
+    layouts = params["layouts"]
+    R = layouts.shape[1]
+    C = _design_regs(params["regions"], params["regions"])
+
+    # Channels per (simulation, patient, region)
+    n_c = layouts[rng.integers(0, len(layouts), (n_sim, n_pats))]
+    if n_chans is not None:
+        n_c = n_chans * (n_c > 0)
+
+    # Channel values, accumulated per cell
+    cell = np.repeat(np.arange(n_c.size), n_c.ravel())
+    u = rng.normal(0, np.sqrt(params["sigma2_pat"]), n_sim * n_pats)
+    e = rng.normal(0, np.sqrt(params["sigma2"]), len(cell))
+    y = (C @ beta)[cell % R] + u[cell // R] + e
+    s_c = np.bincount(cell, y, minlength=n_c.size).reshape(n_c.shape)
+    yty = np.bincount(cell // (n_pats * R), y ** 2, minlength=n_sim)
+
+    sums = _batch_sums_regs(n_c, s_c, yty, C)
+    log_theta0 = np.log(params["sigma2_pat"] / params["sigma2"])
+    fit = fit_lme_batch(sums, _df_regs(n_c), log_theta0)
+    pval = wald_test(fit, np.arange(1, R))[3]
+
+    return pval < alpha
+
+
+def _sim_chunk_corr(params, beta, n_pats, n_chans, alpha, n_sim, seed):
+    """Rejections of the slope in a chunk of simulated cohorts"""
+
+    rng = np.random.default_rng(seed)
+    layouts = params["layouts"]
+
+    # Channels per (simulation, patient)
+    n = layouts[rng.integers(0, len(layouts), n_sim * n_pats)]
+    if n_chans is not None:
+        n = np.full_like(n, n_chans)
+
+    group = np.repeat(np.arange(n_sim * n_pats), n)
+    v = rng.normal(0, np.sqrt(params["sigma2_x_pat"]), n_sim * n_pats)
+    u = rng.normal(0, np.sqrt(params["sigma2_pat"]), n_sim * n_pats)
+    x = params["mu_x"] + v[group]
+    x += rng.normal(0, np.sqrt(params["sigma2_x"]), len(group))
+    y = beta[0] + beta[1] * x + u[group]
+    y += rng.normal(0, np.sqrt(params["sigma2"]), len(group))
+
+    sums = _batch_sums_corr(x, y, group, n_sim, n_pats)
+    N = n.reshape(n_sim, n_pats).sum(axis=1)
+    df = np.column_stack([np.full(n_sim, n_pats - 1), N - n_pats - 1])
+    log_theta0 = np.log(params["sigma2_pat"] / params["sigma2"])
+    fit = fit_lme_batch(sums, df, log_theta0)
+    pval = wald_test(fit, [1])[3]
+
+    return pval < alpha
+
+
+def _power_curve(func, params, n_pats, n_chans, effects, alpha, n_sim, n_jobs, seed):
+    """Power (and its standard error) for every number of patients and channels,
+    and scaling of the effects (all fixed effects except the intercept)."""
+
+    confs = [(m, c, s) for s in effects for c in n_chans for m in n_pats]
+    n_chunks = int(np.ceil(n_sim / chunk_size))
+    sizes = [min(chunk_size, n_sim - i * chunk_size) for i in range(n_chunks)]
+    seeds = np.random.SeedSequence(seed).spawn(len(confs) * n_chunks)
+
+    args = []
+    for i, (m, c, s) in enumerate(confs):
+        beta = np.r_[params["beta"][0], s * params["beta"][1:]]
+        for n, ss in zip(sizes, seeds[i * n_chunks : (i + 1) * n_chunks]):
+            args.append((params, beta, m, c, alpha, n, ss))
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            res = list(executor.map(func, *zip(*args)))
+    else:
+        res = [func(*a) for a in args]
+
+    rejected = np.concatenate(res).reshape(len(confs), n_sim)
+    power = rejected.mean(axis=1)
+    df_power = pd.DataFrame(confs, columns=["n_pats", "n_chans", "effect"])
+    df_power["n_chans"] = [np.nan if c is None else c for _, c, _ in confs]
+    df_power["power"] = power
+    df_power["power_se"] = np.sqrt(power * (1 - power) / n_sim)
+    df_power["n_sim"] = n_sim
+    df_power.index = _r_index(len(df_power))
+
+    return df_power
+
+
+def compute_power_regs(
+    data,
+    var,
+    save_path,
+    save_name_add="",
+    n_pats=(10, 20, 30, 40, 50),
+    n_chans=(None,),
+    effects=(1.0,),
+    alpha=0.05,
+    n_sim=1000,
+    n_jobs=1,
+    seed=0,
+    regions=Regions,
+):
+    """Power of the LME test on 'categorical' data with 'region' factor
+    (as LME_regs_single.R), by simulation.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient, region and parameter data.
+    var : str
+        Name of the variable of interest in data.
+    save_path : str
+        Path where the csv file is saved.
+    save_name_add : str
+        Additional string to append to the csv file name.
+    n_pats : list of int
+        Numbers of patients of the simulated cohorts.
+    n_chans : list
+        Numbers of channels per region sampled in each patient. None (Default)
+        keeps the channels of the original patients.
+    effects : list of float
+        Scalings of the region effects estimated on data (1 is the observed effect).
+    alpha : float
+        Level of significance.
+    n_sim : int
+        Number of simulated cohorts per configuration. Default to 1000.
+    n_jobs : int
+        Number of processes evaluating the simulations. Default to 1.
+    seed : int
+        Seed of the random generator (results do not depend on n_jobs).
+    regions : list
+        Levels of the 'region' factor, the first is the reference.
+
+    Returns
+    -------
+    df_power : pandas DataFrame
+        Power and its standard error for every number of patients (n_pats),
+        of channels (n_chans, NaN if original) and scaling of the effect (effect).
+        Cohorts missing a region count as not significant.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    params = estimate_regs(data, var, regions)
+    df_power = _power_curve(
+        _sim_chunk_regs, params, n_pats, n_chans, effects, alpha, n_sim, n_jobs, seed
+    )
+    _write_csv(df_power, save_path + "Power_regs_" + var + save_name_add + ".csv")
+
+    return df_power
+
+
+def compute_power_corr(
+    data,
+    var_x,
+    var_y,
+    save_path,
+    save_name_add="",
+    n_pats=(10, 20, 30, 40, 50),
+    n_chans=(None,),
+    effects=(1.0,),
+    alpha=0.05,
+    n_sim=1000,
+    n_jobs=1,
+    seed=0,
+):
+    """Power of the LME regression with random intercepts (as LME_corr.R),
+    by simulation.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient (pat), region and parameters data (x and y).
+    var_x : str
+        Name of the independent variable (for file name).
+    var_y : str
+        Name of the dependent variable (for file name).
+    save_path : str
+        Path where the csv file is saved.
+    save_name_add : str
+        Additional string to append to the csv file name.
+    n_pats : list of int
+        Numbers of patients of the simulated cohorts.
+    n_chans : list
+        Numbers of channels sampled in each patient. None (Default) keeps the
+        channels of the original patients.
+    effects : list of float
+        Scalings of the slope estimated on data (1 is the observed slope).
+    alpha : float
+        Level of significance (divide by the number of regions to power
+        Bonferroni-corrected tests on single regions).
+    n_sim : int
+        Number of simulated cohorts per configuration. Default to 1000.
+    n_jobs : int
+        Number of processes evaluating the simulations. Default to 1.
+    seed : int
+        Seed of the random generator (results do not depend on n_jobs).
+
+    Returns
+    -------
+    df_power : pandas DataFrame
+        Power and its standard error for every number of patients (n_pats),
+        of channels (n_chans, NaN if original) and scaling of the slope (effect).
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    params = estimate_corr(data)
+    df_power = _power_curve(
+        _sim_chunk_corr, params, n_pats, n_chans, effects, alpha, n_sim, n_jobs, seed
+    )
+    _write_csv(
+        df_power,
+        save_path + "Power_corr_" + var_x + "_" + var_y + save_name_add + ".csv",
+    )
+
+    return df_power
+
+
+def run_power_regs(df_data, var, save_path, save_name_add="", **kwargs):
+    """Run power simulation of the region test and return pandas objects."""
+
+    # First, make the index a column
+    df_data_py = df_data.reset_index()
+
+    return compute_power_regs(df_data_py, var, save_path, save_name_add, **kwargs)
+
+
+def run_power_corr(df_data, var_x, var_y, save_path, save_name_add="", **kwargs):
+    """Run power simulation of correlations and return pandas objects."""
+
+    # First, make the index a 'pat' column
+    df_data_py = df_data.rename_axis("pat").reset_index()
+
+    # Then, keep only pat, region, var_x and var_y varibles and re-name
+    df_data_py = df_data_py.loc[:, ["pat", "region", var_x, var_y]]
+    df_data_py.columns = ["pat", "region", "x", "y"]
+
+    return compute_power_corr(
+        df_data_py, var_x, var_y, save_path, save_name_add, **kwargs
+    )
@@ -0,0 +1,288 @@
+"""
+Leave-one-patient-out (LOPO) sensitivity of the region and correlation tests.
+
+Leaving a patient out only removes its terms from the per-patient sums of the
+REML likelihood (see utils.lme). The sums of the full cohort are thus downdated
+for every patient at once, and all leave-one-out models are fitted together
+(see lme.fit_lme_batch) from the full-cohort variance ratio, instead of
+refitting every model from the data.
+
+Influence of each patient is summarized by Cook's distance and standardized
+changes (DFBETAS) of the fixed effects, and by whether the test's significance
+changes without it.
+"""
+
+import numpy as np
+import pandas as pd
+
+from utils.lme import (
+    Regions,
+    fit_lme,
+    fit_lme_batch,
+    wald_test,
+    region_means,
+    _design_regs,
+    _r_index,
+    _write_csv,
+    _format_save_name,
+)
+
+
+def _lopo_sums(X, y, groups):
+    """Per-group sums of the full data, and the same sums without each group
+    (one 'leave-out' per row, with the left-out group zeroed)."""
+
+    _, idx = np.unique(np.asarray(groups), return_inverse=True)
+    M = idx.max() + 1
+    p = X.shape[1]
+
+    n = np.bincount(idx, minlength=M).astype(float)
+    sX = np.zeros((M, p))
+    sY = np.zeros(M)
+    XtX = np.zeros((M, p, p))
+    XtY = np.zeros((M, p))
+    yty = np.zeros(M)
+    np.add.at(sX, idx, X)
+    np.add.at(sY, idx, y)
+    np.add.at(XtX, idx, X[:, :, None] * X[:, None, :])
+    np.add.at(XtY, idx, X * y[:, None])
+    np.add.at(yty, idx, y ** 2)
+
+    # Columns varying within each group
+    col_min = np.full((M, p), np.inf)
+    col_max = np.full((M, p), -np.inf)
+    np.minimum.at(col_min, idx, X)
+    np.maximum.at(col_max, idx, X)
+    inner = col_max - col_min > 0
+
+    keep = 1 - np.eye(M)
+    sums = {
+        "n": keep * n[None, :],
+        "sX": keep[:, :, None] * sX[None],
+        "sY": keep * sY[None, :],
+        "XtX": XtX.sum(axis=0)[None] - XtX,
+        "XtY": XtY.sum(axis=0)[None] - XtY,
+        "yty": yty.sum() - yty,
+    }
+    inner = np.array([inner[keep[l] > 0].any(axis=0) for l in range(M)])
+
+    return sums, inner, n
+
+
+def _lopo_fits(X, y, groups, cols):
+    """Full fit and leave-one-group-out fits, with Wald tests on cols.
+
+    Returns the full fit, group labels, their number of observations, and the fits
+    of every leave-out (see lme.fit_lme_batch), with F-values, denominator degrees
+    of freedom, p-values and marginal R2.
+    """
+
+    y = np.asarray(y, dtype=np.float64)
+    fit = fit_lme(X, y, groups)
+    sums, inner, n_obs = _lopo_sums(X, y, groups)
+    M = len(n_obs)
+
+    # Degrees of freedom (as nlme) of every leave-out
+    N = sums["n"].sum(axis=1)
+    p = X.shape[1]
+    n_inner = inner.sum(axis=1, keepdims=True)
+    df = np.where(inner, (N - (M - 1))[:, None] - n_inner, (M - 1) - (p - n_inner))
+
+    # Downdated sums, searched from the full-cohort estimate
+    log_theta0 = np.log(fit["sigma2_pat"][0] / fit["sigma2"][0])
+    lopo = fit_lme_batch(sums, df, log_theta0)
+    lopo["F"], _, lopo["dendf"], lopo["pval"] = wald_test(lopo, cols)
+
+    # Marginal R2, with variance of fitted values from the sums
+    beta = lopo["beta"]
+    var_fix = (
+        np.einsum("lp,lpq,lq->l", beta, sums["XtX"], beta)
+        - np.einsum("lp,lp->l", beta, sums["sX"].sum(axis=1)) ** 2 / N
+    ) / (N - 1)
+    lopo["r2"] = var_fix / (var_fix + lopo["sigma2_pat"] + lopo["sigma2"])
+
+    return fit, np.unique(np.asarray(groups)), n_obs, lopo
+
+
+def _influence(fit, lopo, names, pval_full, alpha):
+    """Cook's distance, DFBETAS and change of significance of every leave-out"""
+
+    diff = fit["beta"] - lopo["beta"]
+    V = fit["varFix"][0]
+    cook = np.einsum("lp,lp->l", diff, np.linalg.solve(V, diff.T).T) / diff.shape[1]
+    dfbetas = diff / np.sqrt(np.diag(V))[None, :]
+
+    df_infl = pd.DataFrame(dfbetas, columns=["dfbetas_" + c for c in names])
+    df_infl.insert(0, "cook", cook)
+    df_infl["sig_change"] = (lopo["pval"] < alpha) != (pval_full < alpha)
+
+    return df_infl
+
+
+def compute_lopo_regs(
+    data, var, save_path, save_name_add="", alpha=0.05, regions=Regions
+):
+    """Leave-one-patient-out sensitivity of the LME test on 'categorical' data
+    with 'region' factor (as LME_regs_single.R).
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient, region and parameter data.
+    var : str
+        Name of the variable of interest in data.
+    save_path : str
+        Path where the csv files are saved.
+    save_name_add : str
+        Additional string to append to the csv file names.
+    alpha : float
+        Level of significance, to flag patients whose removal changes significance.
+    regions : list
+        Levels of the 'region' factor, the first is the reference.
+
+    Returns
+    -------
+    Results : list
+        A list with two dataframes, with one row per left-out patient:
+          - df_lopo : region means and SE, F-value and p-value for overall significance.
+          - df_infl : number of channels, Cook's distance, DFBETAS of the
+            fixed effects and change of significance, sorted by Cook's distance.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    X = _design_regs(data["region"], regions)
+    cols = np.arange(1, len(regions))
+    fit, pats, n_obs, lopo = _lopo_fits(X, data[var], data["pat"], cols)
+    pval_full = wald_test(fit, cols)[3][0]
+
+    means, sems = region_means(lopo)
+    df_lopo = pd.DataFrame(
+        np.hstack([means, sems]),
+        columns=[r + "_mean" for r in regions] + [r + "_sem" for r in regions],
+    )
+    df_lopo.insert(0, "n_chans", n_obs.astype(int))
+    df_lopo.insert(0, "pat", pats)
+    df_lopo["statistics"] = lopo["F"]
+    df_lopo["dendf"] = lopo["dendf"].astype(np.float64)
+    df_lopo["pvalue"] = lopo["pval"]
+    df_lopo.index = _r_index(len(pats))
+
+    df_infl = _influence(fit, lopo, regions, pval_full, alpha)
+    df_infl.insert(0, "n_chans", n_obs.astype(int))
+    df_infl.insert(0, "pat", pats)
+    df_infl = df_infl.sort_values("cook", ascending=False)
+    df_infl.index = _r_index(len(pats))
+
+    # Save
+    _write_csv(df_lopo, save_path + "Test_lopo_" + var + save_name_add + ".csv")
+    _write_csv(df_infl, save_path + "Test_lopo_infl_" + var + save_name_add + ".csv")
+
+    return [df_lopo, df_infl]
+
+
+def compute_lopo_corr(
+    data,
+    var_x,
+    var_y,
+    save_path,
+    save_name_add="",
+    region=None,
+    alpha=0.05,
+    regions=Regions,
+):
+    """Leave-one-patient-out sensitivity of the LME regression with random
+    intercepts (as LME_corr.R).
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient (pat), region and parameters data (x and y).
+    var_x : str
+        Name of the independent variable (for file name).
+    var_y : str
+        Name of the dependent variable (for file name).
+    save_path : str
+        Path where the csv files are saved.
+    save_name_add : str
+        Additional string to append to the csv file names.
+    region : str
+        If given, restrict the regression to one region, with Bonferroni
+        correction over regions (as in LME_corr.R). Default to all regions.
+    alpha : float
+        Level of significance, to flag patients whose removal changes significance.
+    regions : list
+        Regions of the single regressions.
+
+    Returns
+    -------
+    Results : list
+        A list with two dataframes, with one row per left-out patient:
+          - df_lopo : slope (m), intercept (q), rho, F-value and p-value.
+          - df_infl : number of channels, Cook's distance, DFBETAS of
+            intercept and slope and change of significance, sorted by Cook's distance.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+    n_tests = 1
+    if region is not None:
+        data = data[data["region"] == region]
+        save_name_add = "_" + region + save_name_add
+        n_tests = len(regions)
+
+    X = np.column_stack([np.ones(len(data)), data["x"].to_numpy(dtype=np.float64)])
+    fit, pats, n_obs, lopo = _lopo_fits(X, data["y"], data["pat"], [1])
+    pval_full = min(wald_test(fit, [1])[3][0] * n_tests, 1)
+    lopo["pval"] = np.minimum(lopo["pval"] * n_tests, 1)  # Bonferroni correction
+
+    m = lopo["beta"][:, 1]
+    df_lopo = pd.DataFrame(
+        {
+            "pat": pats,
+            "n_chans": n_obs.astype(int),
+            "m": m,
+            "q": lopo["beta"][:, 0],
+            "rho": np.sqrt(lopo["r2"]) * np.sign(m),
+            "statistics": lopo["F"],
+            "dendf": lopo["dendf"].astype(np.float64),
+            "pval": lopo["pval"],
+        },
+        index=_r_index(len(pats)),
+    )
+
+    df_infl = _influence(fit, lopo, ["q", "m"], pval_full, alpha)
+    df_infl.insert(0, "n_chans", n_obs.astype(int))
+    df_infl.insert(0, "pat", pats)
+    df_infl = df_infl.sort_values("cook", ascending=False)
+    df_infl.index = _r_index(len(pats))
+
+    # Save
+    save_name = var_x + "_" + var_y + save_name_add
+    _write_csv(df_lopo, save_path + "Test_lopo_corr_" + save_name + ".csv")
+    _write_csv(df_infl, save_path + "Test_lopo_infl_corr_" + save_name + ".csv")
+
+    return [df_lopo, df_infl]
+
+
+def run_lopo_regs(df_data, var, save_path, save_name_add="", **kwargs):
+    """Run leave-one-patient-out region test and return pandas objects."""
+
+    # First, make the index a column
+    df_data_py = df_data.reset_index()
+
+    return compute_lopo_regs(df_data_py, var, save_path, save_name_add, **kwargs)
+
+
+def run_lopo_corr(df_data, var_x, var_y, save_path, save_name_add="", **kwargs):
+    """Run leave-one-patient-out test of correlations and return pandas objects."""
+
+    # First, make the index a 'pat' column
+    df_data_py = df_data.rename_axis("pat").reset_index()
+
+    # Then, keep only pat, region, var_x and var_y varibles and re-name
+    df_data_py = df_data_py.loc[:, ["pat", "region", var_x, var_y]]
+    df_data_py.columns = ["pat", "region", "x", "y"]
+
+    return compute_lopo_corr(
+        df_data_py, var_x, var_y, save_path, save_name_add, **kwargs
+    )
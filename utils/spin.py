@@ -0,0 +1,234 @@
+"""
+Spatial ('spin') null of correlations between electrode parameters and MNI
+coordinates (or PLS scores of the coordinates).
+
+Electrodes are projected on a sphere around the centre of the brain surface (or
+of the electrodes), and the sphere is rotated at random. Rotated electrodes are
+assigned to distinct electrodes, minimizing the total distance between rotated
+and assigned positions (Hungarian algorithm, as in Vazquez-Rodriguez et al., 2019),
+so that null maps are permutations of the parameter which keep its spatial
+autocorrelation, as in the spin test of Alexander-Bloch et al. (2018) for
+electrodes instead of surface vertices.
+
+Electrodes only cover parts of the sphere: electrodes rotated where there are no
+electrodes are assigned to the closest electrodes left, which can be far away.
+The mean angle between rotated and assigned positions of every null map is
+returned, and its median is saved with the p-values (angle_spin), to check that
+null maps mostly preserve the neighbourhoods of the electrodes.
+
+The correlations are the LME regressions with patient random intercepts of
+LME_corr.R, recomputed on every null map: for coordinates all null maps of a
+chunk are fitted at once as columns of the response, and for PLS (refitted on
+every null map) the scores of all null maps of a chunk are fitted together from
+per-patient sums. Chunks are evaluated in parallel processes.
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
+from scipy.spatial.transform import Rotation
+
+from utils.lme import (
+    fit_lme,
+    fit_lme_batch,
+    _batch_sums_corr,
+    _r_index,
+    _write_csv,
+    _format_save_name,
+)
+
+# Number of null maps evaluated together
+chunk_size = 500
+
+
+def sphere_directions(coords, surf=None):
+    """Unit vectors from the centre of the surface (if given, otherwise of the
+    electrodes) to the electrodes (N, 3)."""
+
+    centre = (surf.coordinates if surf is not None else coords).mean(axis=0)
+    dirs = coords - centre
+
+    return dirs / np.linalg.norm(dirs, axis=1, keepdims=True)
+
+
+def spin_permutations(dirs, n_rot, rng):
+    """(n_rot, N) permutations of the electrodes by random rotations, each rotated
+    electrode assigned to a distinct electrode (minimal total distance), and
+    (n_rot,) mean angles (degrees) between rotated and assigned positions."""
+
+    rot = Rotation.random(n_rot, random_state=rng).as_matrix()  # (n_rot, 3, 3)
+    rotated = np.einsum("rij,nj->rni", rot, dirs)
+
+    idx = np.empty((n_rot, len(dirs)), dtype=int)
+    angle = np.empty(n_rot)
+    for r in range(n_rot):
+        dist = cdist(rotated[r], dirs)
+        rows, cols = linear_sum_assignment(dist)
+        idx[r, rows] = cols
+        angle[r] = np.degrees(
+            np.mean(2 * np.arcsin(np.clip(dist[rows, cols] / 2, 0, 1)))
+        )
+
+    return idx, angle
+
+
+def pls_scores(coords, Y):
+    """Scores of one-component PLS regressions of the columns of Y on coords
+    (as sklearn's PLSRegression(n_components=1).x_scores_), (N, S)."""
+
+    Xs = (coords - coords.mean(axis=0)) / coords.std(axis=0, ddof=1)
+    Ys = (Y - Y.mean(axis=0)) / Y.std(axis=0, ddof=1)
+    W = Xs.T @ Ys
+    W /= np.linalg.norm(W, axis=0, keepdims=True)
+
+    return Xs @ W
+
+
+def _t_slope(fit):
+    """t-values of the slope of 'y ~ x' fits"""
+
+    return fit["beta"][:, 1] / np.sqrt(fit["varFix"][:, 1, 1])
+
+
+def _spin_chunk(dirs, coords, X_vars, y, group_idx, pls, n_null, seed):
+    """t-values of the slopes of a chunk of null maps, (n_null, n_vars), and mean
+    angles of their assignments, (n_null,)"""
+
+    rng = np.random.default_rng(seed)
+    idx, angle = spin_permutations(dirs, n_null, rng)
+    Y = y[idx].T  # (N, n_null)
+    ones = np.ones(len(y))
+
+    t = [
+        _t_slope(fit_lme(np.column_stack([ones, x]), Y, group_idx, "newton"))
+        for x in X_vars.T
+    ]
+    if pls:
+        M = group_idx.max() + 1
+        group = (group_idx[:, None] + M * np.arange(n_null)[None, :]).T.ravel()
+        scores = pls_scores(coords, Y)
+        sums = _batch_sums_corr(scores.T.ravel(), Y.T.ravel(), group, n_null, M)
+        t.append(_t_slope(fit_lme_batch(sums)))
+
+    return np.column_stack(t), angle
+
+
+def compute_spin_corr(
+    data,
+    var_y,
+    save_path,
+    save_name_add="",
+    vars_x=("mni_x", "mni_y", "mni_z"),
+    pls=True,
+    pls_name="pls_x",
+    surf=None,
+    n_null=10000,
+    n_jobs=1,
+    seed=0,
+):
+    """Spin test of the LME correlations between a parameter and MNI coordinates.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Dataframe containing patient (pat), MNI coordinates (mni_x, mni_y, mni_z)
+        and the parameter (as returned by helpers.get_MNI_params).
+    var_y : str
+        Name of the parameter in data.
+    save_path : str
+        Path where the csv file is saved.
+    save_name_add : str
+        Additional string to append to the csv file name.
+    vars_x : list of str
+        Coordinates to correlate with the parameter.
+    pls : bool
+        If True (Default), also test the scores of a one-component PLS regression
+        of the parameter on the coordinates, refitted on every null map.
+    pls_name : str
+        Column of data with the (in-sample) PLS scores tested on the data, as in
+        the MNI scripts. Default to 'pls_x', computed here if not in data.
+    surf : surface object
+        Brain surface (e.g. from nilearn's load_surf_mesh), whose centre is the
+        centre of the sphere. Default to the centre of the electrodes.
+    n_null : int
+        Number of null maps (rotations). Default to 10000.
+    n_jobs : int
+        Number of processes evaluating the null maps. Default to 1.
+    seed : int
+        Seed of the random generator (results do not depend on n_jobs).
+
+    Returns
+    -------
+    Results : list
+        - df_spin : slope (m), t-value and rho of the LME fits on the data,
+          two-sided spin p-value (pval_spin) for every variable (var_x), and
+          median over null maps of the mean angle (degrees) between rotated and
+          assigned electrodes (angle_spin).
+        - t_null : (n_null, n_vars) t-values of the slopes on the null maps.
+        - angle_null : (n_null,) mean angles of the assignments of every null map.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    data = data.dropna(subset=[var_y])
+    coords = data[["mni_x", "mni_y", "mni_z"]].to_numpy(dtype=np.float64)
+    y = data[var_y].to_numpy(dtype=np.float64)
+    _, group_idx = np.unique(np.asarray(data["pat"]), return_inverse=True)
+    dirs = sphere_directions(coords, surf)
+
+    # Fits on the data
+    x_data = [data[v].to_numpy(dtype=np.float64) for v in vars_x]
+    names = list(vars_x)
+    if pls:
+        if pls_name in data:
+            x_data.append(data[pls_name].to_numpy(dtype=np.float64))
+        else:
+            x_data.append(pls_scores(coords, y[:, None])[:, 0])
+        names.append(pls_name)
+    res = []
+    for x in x_data:
+        X = np.column_stack([np.ones(len(x)), x])
+        fit = fit_lme(X, y, group_idx)
+        var_fix = np.var(X @ fit["beta"][0], ddof=1)
+        r2 = var_fix / (var_fix + fit["sigma2_pat"][0] + fit["sigma2"][0])
+        m = fit["beta"][0, 1]
+        res.append([m, _t_slope(fit)[0], np.sqrt(r2) * np.sign(m)])
+    res = np.array(res)
+
+    # Null maps, in chunks of rotations
+    X_vars = data[list(vars_x)].to_numpy(dtype=np.float64)
+    n_chunks = int(np.ceil(n_null / chunk_size))
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    sizes = [min(chunk_size, n_null - i * chunk_size) for i in range(n_chunks)]
+    args = [
+        (dirs, coords, X_vars, y, group_idx, pls, n, s) for n, s in zip(sizes, seeds)
+    ]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            chunks = list(executor.map(_spin_chunk, *zip(*args)))
+    else:
+        chunks = [_spin_chunk(*a) for a in args]
+    t_null = np.concatenate([c[0] for c in chunks])
+    angle_null = np.concatenate([c[1] for c in chunks])
+
+    pval = (1 + np.sum(np.abs(t_null) >= np.abs(res[:, 1]), axis=0)) / (n_null + 1)
+    df_spin = pd.DataFrame(
+        {"var_x": names, "m": res[:, 0], "t": res[:, 1], "rho": res[:, 2]},
+        index=_r_index(len(names)),
+    )
+    df_spin["pval_spin"] = pval
+    df_spin["angle_spin"] = np.median(angle_null)
+    _write_csv(df_spin, save_path + "Test_spin_" + var_y + save_name_add + ".csv")
+
+    return [df_spin, t_null, angle_null]
+
+
+def run_spin_corr(df_data, var_y, save_path, save_name_add="", **kwargs):
+    """Run spin test of MNI correlations and return pandas objects."""
+
+    # First, make the index a 'pat' column
+    df_data_py = df_data.rename_axis("pat").reset_index()
+
+    return compute_spin_corr(df_data_py, var_y, save_path, save_name_add, **kwargs)
@@ -0,0 +1,356 @@
+"""
+Sufficient statistics of random-intercept LMEs, aggregated per patient and region.
+
+For 'var ~ region, random = ~1 | pat' (LME_regs_single.R) and
+'y ~ x, random = ~1 | pat' (LME_corr.R), the REML likelihood only depends on
+per-patient counts, sums and cross-products of the variables. These are kept
+for every (patient, region) cell, so that the regression can be fitted on all
+regions or on one region only. Missing values are skipped per variable (and per
+pair of variables for cross-products), so that every model uses all the channels
+where its variables are available. Summaries are built while streaming through channel
+tables (e.g. csv files read in chunks), summaries of separately processed shards
+(of patients or channels) are merged by adding them, and models are fitted
+from the summaries alone.
+
+Example
+-------
+>>> summ = Summaries(["tau", "onset"])
+>>> for df_shard in shards:
+...     summ.update(df_shard)
+>>> df_coef, df_test = compute_test_regs_summaries(summ, "tau", save_path)
+>>> df_test = compute_test_corr_summaries(summ, "tau", "onset", save_path)
+"""
+
+import numpy as np
+import pandas as pd
+
+from utils.lme import (
+    Regions,
+    fit_lme_sums,
+    wald_test,
+    _regs_tables,
+    _corr_table,
+    _design_regs,
+    _write_csv,
+    _format_save_name,
+)
+
+# Relative tolerance on within-patient variability (for degrees of freedom)
+within_tol = 1e-10
+
+
+class Summaries:
+    """Counts, sums and cross-products of variables per (patient, region).
+
+    With cross=True, counts (n), sums (s) and sums of squares (sq) are (M, R, V, V)
+    arrays over the channels where both variables i and j are available, with
+    s[..., i, j] and sq[..., i, j] of variable i (the diagonals are over the
+    channels where variable i is available), and ss[..., i, j] are the
+    cross-products. With cross=False, n, s and sq are (M, R, V) arrays over the
+    channels where each variable is available, and ss is empty.
+
+    Parameters
+    ----------
+    variables : list of str
+        Variables to summarize.
+    regions : list
+        Levels of the 'region' factor, the first is the reference.
+    cross : bool
+        If True (Default), store cross-products between all variables (needed for
+        correlations), otherwise only squares (enough for region tests, e.g. on
+        many steps).
+    """
+
+    _arrays = ("n", "s", "sq", "ss")
+
+    def __init__(self, variables, regions=Regions, cross=True):
+
+        self.variables = list(variables)
+        self.regions = list(regions)
+        self.cross = cross
+        self.pats = []
+        self._pat_idx = {}
+
+        V, R = len(self.variables), len(self.regions)
+        shape = (0, R, V, V) if cross else (0, R, V)
+        self.n = np.zeros(shape)
+        self.s = np.zeros(shape)
+        self.sq = np.zeros(shape)
+        self.ss = np.zeros(shape if cross else (0, R, 0))
+
+    def _pat_index(self, pats):
+        """Indexes of patients in the summaries, adding new ones"""
+
+        new = [p for p in pd.unique(np.asarray(pats)) if p not in self._pat_idx]
+        for p in new:
+            self._pat_idx[p] = len(self.pats)
+            self.pats.append(p)
+
+        if len(new) > 0:
+            for name in self._arrays:
+                arr = getattr(self, name)
+                zeros = np.zeros((len(new),) + arr.shape[1:])
+                setattr(self, name, np.concatenate([arr, zeros]))
+
+        return np.array([self._pat_idx[p] for p in pats], dtype=np.intp)
+
+    def update(self, df_data):
+        """Add channels (rows) of df_data, with patients in the index or in a 'pat'
+        column. Missing values are skipped per variable (and pair of variables)."""
+
+        if "pat" not in df_data.columns:
+            df_data = df_data.rename_axis("pat").reset_index()
+        data = df_data[["pat", "region"] + self.variables].dropna(
+            subset=["pat", "region"]
+        )
+
+        region = np.asarray(data["region"])
+        if not np.isin(region, self.regions).all():
+            raise ValueError(
+                "Unknown levels in 'region': all must be in " + str(self.regions)
+            )
+        reg_idx = pd.Index(self.regions).get_indexer(region)
+        pat_idx = self._pat_index(data["pat"].to_numpy())
+        Y = data[self.variables].to_numpy(dtype=np.float64)
+        valid = ~np.isnan(Y)
+        Y = np.where(valid, Y, 0)
+
+        cell = (pat_idx, reg_idx)
+        if self.cross:
+            both = valid[:, None, :]
+            np.add.at(self.n, cell, valid[:, :, None] & both)
+            np.add.at(self.s, cell, Y[:, :, None] * both)
+            np.add.at(self.sq, cell, Y[:, :, None] ** 2 * both)
+            np.add.at(self.ss, cell, Y[:, :, None] * Y[:, None, :])
+        else:
+            np.add.at(self.n, cell, valid)
+            np.add.at(self.s, cell, Y)
+            np.add.at(self.sq, cell, Y ** 2)
+
+        return self
+
+    def var_sums(self, j):
+        """Counts, sums and sums of squares of variables j (indexes) per
+        (patient, region), over the channels where each is available, (M, R, J)"""
+
+        if self.cross:
+            return self.n[..., j, j], self.s[..., j, j], self.sq[..., j, j]
+
+        return self.n[..., j], self.s[..., j], self.sq[..., j]
+
+    def merge(self, other):
+        """Add the summaries of another shard (with the same variables and regions)"""
+
+        if (
+            other.variables != self.variables
+            or other.regions != self.regions
+            or other.cross != self.cross
+        ):
+            raise ValueError(
+                "Summaries must have the same variables, regions and cross."
+            )
+
+        idx = self._pat_index(other.pats)
+        for name in self._arrays:
+            getattr(self, name)[idx] += getattr(other, name)
+
+        return self
+
+    def __add__(self, other):
+
+        return self.copy().merge(other)
+
+    def copy(self):
+        """Copy of the summaries"""
+
+        summ = Summaries(self.variables, self.regions, self.cross)
+
+        return summ.merge(self)
+
+    def save(self, file_name):
+        """Save summaries to a (compressed) npz file"""
+
+        np.savez_compressed(
+            file_name,
+            pats=np.array(self.pats),
+            variables=np.array(self.variables),
+            regions=np.array(self.regions),
+            cross=self.cross,
+            **{name: getattr(self, name) for name in self._arrays}
+        )
+
+    @classmethod
+    def load(cls, file_name):
+        """Load summaries saved with save"""
+
+        with np.load(file_name, allow_pickle=False) as f:
+            summ = cls(f["variables"].tolist(), f["regions"].tolist(), bool(f["cross"]))
+            summ._pat_index(f["pats"].tolist())
+            for name in cls._arrays:
+                setattr(summ, name, f[name])
+
+        return summ
+
+
+def summarize_csv(file_names, variables, regions=Regions, cross=True, chunksize=100000):
+    """Summaries of channel tables saved in csv files (with patients in the first
+    column), read in chunks of rows."""
+
+    if isinstance(file_names, str):
+        file_names = [file_names]
+
+    summ = Summaries(variables, regions, cross)
+    for file_name in file_names:
+        for df_chunk in pd.read_csv(file_name, index_col=0, chunksize=chunksize):
+            summ.update(df_chunk)
+
+    return summ
+
+
+def _fix_df_cells(inner, M, N):
+    """Denominator degrees of freedom as in nlme (see lme._fix_df)"""
+
+    return np.where(inner, N - M - np.sum(inner), M - np.sum(~inner))
+
+
+def fit_regs(summ, variables):
+    """Fit 'var ~ region' LMEs from the summaries, for all variables at once
+    (variables must be available on the same channels, e.g. steps)"""
+
+    if isinstance(variables, str):
+        variables = [variables]
+    j = [summ.variables.index(v) for v in variables]
+
+    n, s, sq = summ.var_sums(j)
+    if not (n == n[..., :1]).all():
+        raise ValueError(
+            "Variables available on different channels must be fitted separately."
+        )
+    keep = n[..., 0].sum(axis=1) > 0
+    n, s, sq = n[keep][..., 0], s[keep], sq[keep]
+    if (n.sum(axis=0) == 0).any():
+        raise ValueError("Every level of 'region' needs at least one observation.")
+
+    # One row of the design matrix per region
+    C = _design_regs(summ.regions, summ.regions)
+    sums = {
+        "n": n.sum(axis=1),
+        "sX": n @ C,
+        "sY": s.sum(axis=1),
+        "XtX": C.T @ (n.sum(axis=0)[:, None] * C),
+        "XtY": C.T @ s.sum(axis=0),
+        "yty": sq.sum(axis=(0, 1)),
+    }
+
+    # Columns varying within patients
+    inner = ((n @ C > 0) & (n @ (1 - C) > 0)).any(axis=0)
+
+    return fit_lme_sums(sums, _fix_df_cells(inner, len(n), n.sum()))
+
+
+def fit_corr(summ, var_x, var_y, region=None):
+    """Fit 'y ~ x' LME from the summaries, on all regions or on one region only.
+
+    Returns the fit and the marginal R2 (as MuMIn's r.squaredGLMM).
+    """
+
+    if not summ.cross:
+        raise ValueError("Correlations need summaries with cross=True.")
+    ix, iy = summ.variables.index(var_x), summ.variables.index(var_y)
+    regs = (
+        np.arange(len(summ.regions))
+        if region is None
+        else [summ.regions.index(region)]
+    )
+
+    # Sums over the channels where both x and y are available
+    n = summ.n[:, regs, ix, iy].sum(axis=1)
+    keep = n > 0
+    n = n[keep]
+    s = summ.s[keep][:, regs].sum(axis=1)
+    sq = summ.sq[keep][:, regs].sum(axis=1)
+    sx, sy = s[:, ix, iy], s[:, iy, ix]
+    sxx, syy = sq[:, ix, iy], sq[:, iy, ix]
+    sxy = summ.ss[keep][:, regs, ix, iy].sum(axis=1)
+
+    N = n.sum()
+    sums = {
+        "n": n,
+        "sX": np.column_stack([n, sx]),
+        "sY": sy[:, None],
+        "XtX": np.array([[N, sx.sum()], [sx.sum(), sxx.sum()]]),
+        "XtY": np.array([[sy.sum()], [sxy.sum()]]),
+        "yty": np.array([syy.sum()]),
+    }
+
+    # Intercept never varies within patients, x does if any within-patient SS
+    inner = np.array(
+        [False, np.any(sxx - sx ** 2 / n > within_tol * np.maximum(sxx, 1))]
+    )
+    fit = fit_lme_sums(sums, _fix_df_cells(inner, len(n), N))
+
+    # Marginal R2, with variance of fitted values from the sums
+    beta = fit["beta"][0]
+    var_fix = (beta @ sums["XtX"] @ beta - (beta @ sums["XtX"][0]) ** 2 / N) / (N - 1)
+    r2 = var_fix / (var_fix + fit["sigma2_pat"][0] + fit["sigma2"][0])
+
+    return fit, r2
+
+
+def compute_test_regs_summaries(summ, var, save_path, save_name_add=""):
+    """Compute LME test on 'categorical' data with 'region' factor from summaries.
+
+    Returns and saves the same dataframes as lme.compute_test_regs.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    fit = fit_regs(summ, var)
+    df_coef, df_test = _regs_tables(fit, summ.regions)[0]
+
+    # Save
+    _write_csv(df_coef, save_path + "Test_coef_" + var + save_name_add + ".csv")
+    _write_csv(df_test, save_path + "Test_pval_" + var + save_name_add + ".csv")
+
+    return [df_coef, df_test]
+
+
+def _corr_row(summ, var_x, var_y, region=None):
+    """m, q, rho, F, numdf, dendf and p-value of 'y ~ x' LME"""
+
+    fit, r2 = fit_corr(summ, var_x, var_y, region)
+    F, numdf, dendf, pval = wald_test(fit, [1])
+    m = fit["beta"][0, 1]
+
+    return [m, fit["beta"][0, 0], np.sqrt(r2) * np.sign(m), F[0], numdf, dendf, pval[0]]
+
+
+def compute_test_corr_summaries(
+    summ, var_x, var_y, save_path, save_name_add="", run_single=True
+):
+    """Compute LME regression with random intercepts from summaries.
+
+    Returns and saves the same dataframe as lme.compute_test_corr.
+    """
+
+    save_name_add = _format_save_name(save_name_add)
+
+    # LME - Random intercepts on all regions
+    Group = ["Overall"]
+    res = [_corr_row(summ, var_x, var_y)]
+
+    # LME - Random intercepts on single regions
+    if run_single:
+        Group += summ.regions
+        for reg in summ.regions:
+            res_reg = _corr_row(summ, var_x, var_y, reg)
+            res_reg[-1] = min(res_reg[-1] * len(summ.regions), 1)  # Bonferroni
+            res.append(res_reg)
+
+    df_test = _corr_table(Group, res)
+    _write_csv(
+        df_test,
+        save_path + "Test_corr_" + var_x + "_" + var_y + save_name_add + ".csv",
+    )
+
+    return df_test